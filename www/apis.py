@@ -3,6 +3,7 @@
 JSON API definition
 """
 import json
+import base64
 import logging
 import inspect
 import functools
@@ -66,6 +67,80 @@ class Page(object):
     __repr__ = __str__
 
 
+def encode_cursor(value, pk, before=False):
+    """
+    Encode a (sort value, primary key) keyset position into an opaque url-safe token.
+    >>> decode_cursor(encode_cursor(1.5, 'abc'))
+    ((1.5, 'abc'), False)
+    >>> decode_cursor(encode_cursor(1.5, 'abc', True))
+    ((1.5, 'abc'), True)
+    >>> decode_cursor('')
+    (None, False)
+    """
+    s = json.dumps([value, pk, 'p' if before else 'n'], separators=(',', ':'))
+    return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    Decode a token made by encode_cursor() into ((sort value, primary key), before).
+    An empty token means the first page. The values go into sql parameters, so a sort value
+    that is not a number or string, or a primary key that is not a string, is rejected.
+    >>> decode_cursor(encode_cursor([1, 2], 'x'))
+    Traceback (most recent call last):
+      ...
+    apis.APIValueError: Invalid cursor.
+    """
+    if not token:
+        return None, False
+    try:
+        s = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        value, pk, direction = json.loads(s)
+    except (ValueError, TypeError):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)) or not isinstance(pk, str) or direction not in ('p', 'n'):
+        raise APIValueError('cursor', 'Invalid cursor.')
+    return (value, pk), direction == 'p'
+
+
+class CursorPage(object):
+    """
+    Page object for keyset (cursor) pagination.
+    """
+    def __init__(self, items, page_size=10, cursor=None, before=False, keys=('created_at', 'id')):
+        """
+        Init pagination from items fetched with limit=page_size + 1 starting at cursor.
+        The extra row only tells whether there is one more page, it is removed from items in place.
+        >>> p1 = CursorPage([dict(created_at=t, id=str(t)) for t in (5, 4, 3)], 2)
+        >>> p1.has_next, p1.has_previous
+        (True, False)
+        >>> decode_cursor(p1.next_cursor)
+        ((4, '4'), False)
+        >>> p2 = CursorPage([dict(created_at=t, id=str(t)) for t in (2, 1)], 2, (4, '4'))
+        >>> p2.has_next, p2.has_previous
+        (False, True)
+        >>> decode_cursor(p2.prev_cursor)
+        ((2, '2'), True)
+        """
+        self.page_size = page_size
+        if before:
+            self.has_previous = len(items) > page_size
+            self.has_next = cursor is not None
+            del items[:-page_size]
+        else:
+            self.has_next = len(items) > page_size
+            self.has_previous = cursor is not None
+            del items[page_size:]
+        value, pk = keys
+        self.next_cursor = encode_cursor(items[-1][value], items[-1][pk]) if items and self.has_next else None
+        self.prev_cursor = encode_cursor(items[0][value], items[0][pk], True) if items and self.has_previous else None
+
+    def __str__(self):
+        return 'page_size: %s, has_next: %s, has_previous: %s' % (self.page_size, self.has_next, self.has_previous)
+
+    __repr__ = __str__
+
+
 class APIError(Exception):
     """
     the base APIError which contains error(required), data(optional) and message(optional).
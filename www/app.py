@@ -16,7 +16,7 @@ from jinja2 import Environment, FileSystemLoader
 
 from config import configs
 
-import orm
+import orm, render
 from coroweb import add_routes, add_static
 
 from handlers import cookie2user, COOKIE_NAME
@@ -60,6 +60,57 @@ async def logger_factory(app, handler):
         return (await handler(request))
     return logger
 
+#sql追踪：收集请求中执行的sql语句，调试模式下在响应头中输出汇总；同一条语句执行次数过多时警告可能的N+1查询
+async def trace_factory(app, handler):
+    async def trace(request):
+        route = getattr(request.match_info, 'handler', None)
+        name = getattr(getattr(route, '_func', route), '__name__', request.path)
+        with orm.tracing(name, configs.db.n_plus_one) as t:
+            request.__trace__ = t
+            r = await handler(request)
+        logging.info('SQL trace %s: %s' % (name, t.summary()))
+        if configs.debug and isinstance(r, web.StreamResponse):
+            r.headers['X-DB-Queries'] = t.summary()
+        return r
+    return trace
+
+#请求的截止时间：请求中所有的sql语句(包括等待数据库连接)必须在request_timeout秒之内完成，超时的语句会被KILL，请求返回503
+async def deadline_factory(app, handler):
+    async def deadline(request):
+        #没有配置request_timeout时，query_timeout导致的超时同样返回503
+        try:
+            if not configs.db.request_timeout:
+                return (await handler(request))
+            with orm.deadline(configs.db.request_timeout):
+                return (await handler(request))
+        except orm.QueryTimeoutError as e:
+            logging.warning('Request %s %s: %s' % (request.method, request.path, e))
+            return web.HTTPServiceUnavailable(text='database timeout')
+    return deadline
+
+#为每个请求开启按主键合并加载，同一个tick里的Model.find()会合并成一条 where id in (...) 查询
+async def loader_factory(app, handler):
+    async def loader(request):
+        with orm.batch_loading():
+            return (await handler(request))
+    return loader
+
+#读写分离：请求中写过数据库之后，一小段时间内的读仍然走主库；用会话cookie作为标识，同一个用户的下一个请求也能读到自己的写
+async def read_scope_factory(app, handler):
+    async def read_scope(request):
+        with orm.read_scope(request.cookies.get(COOKIE_NAME)):
+            return (await handler(request))
+    return read_scope
+
+#unit of work：开启之后，请求中Model的写操作在处理函数返回之后，在一个事务中按表合并执行
+async def unit_of_work_factory(app, handler):
+    async def unit_of_work(request):
+        if not configs.db.unit_of_work:
+            return (await handler(request))
+        async with orm.unit_of_work():
+            return (await handler(request))
+    return unit_of_work
+
 async def auth_factory(app, handler):
     @asyncio.coroutine
     def auth(request):
@@ -154,10 +205,12 @@ def datetime_filter(t):
 
 async def init(loop):
     #异步利用orm创建数据库连接池
-    await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='120788', db='awesome')
+    await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='120788', db='awesome', replicas=configs.db.replicas, query_cache=configs.db.query_cache, single_flight=configs.db.single_flight, row_counters=configs.db.row_counters, slow_query=configs.db.slow_query, query_timeout=configs.db.query_timeout)
+    #markdown渲染服务：大的文章交给进程池渲染
+    render.configure(**configs.render)
     #利用aiohttp模块的web创建应用，并注册中间 件函数
     app = web.Application(loop=loop, middlewares=[
-        logger_factory, auth_factory, data_factory, response_factory
+        logger_factory, trace_factory, deadline_factory, read_scope_factory, loader_factory, unit_of_work_factory, auth_factory, data_factory, response_factory
     ])
     #初始化jinjia2模板，注册模板的filter
     init_jinja2(app, filters=dict(datetime=datetime_filter))
@@ -170,6 +223,8 @@ async def init(loop):
     logging.info('server started at http://127.0.0.1:9001...')
     return srv
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
\ No newline at end of file
+#渲染进程池用forkserver启动子进程，子进程会重新导入这个模块，所以只在直接运行的时候启动server
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(init(loop))
+    loop.run_forever()
\ No newline at end of file
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks for the orm, no database needed.
+
+usage: python3 bench.py rows [count]
+       python3 bench.py ids [count]
+       python3 bench.py hydrate [count]
+       python3 bench.py spans [count]
+       python3 bench.py pool
+'''
+
+import sys, time, gc, bisect, random, tracemalloc, asyncio
+
+import aiomysql, orm, markdown2
+from models import Comment, next_id
+
+#模拟一页评论：每一行都带一段比较长的content
+def fake_rows(n):
+    return [('%050d' % i, '%050d' % (i // 10), 'u%d' % i, 'name%d' % i, 'http://img/%d' % i, 'comment %d ' % i * 20, time.time()) for i in range(n)]
+
+#测量build()创建的对象所占用的内存和耗时，原始行不计算在内
+def measure(build, rows):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    objs = build(rows)
+    elapsed = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return objs, size, elapsed
+
+#比较dict行(DictCursor + Model)和紧凑行(tuple游标 + __slots__)的内存占用
+def bench_rows(n):
+    rows = fake_rows(n)
+    names = (Comment.__primary_key__,) + tuple(Comment.__fields__)
+    dict_rows = [dict(zip(names, r)) for r in rows]
+    objs, dict_size, dict_time = measure(lambda rs: [Comment(**r) for r in rs], dict_rows)
+    del objs
+    objs, row_size, row_time = measure(lambda rs: [Comment.__row__(*r) for r in rs], rows)
+    del objs
+    #dict模式下，DictCursor返回的每一行本身也是一个dict，在构造Model之前同样要占内存
+    gc.collect()
+    tracemalloc.start()
+    cursor_rows = [dict(zip(names, r)) for r in rows]
+    cursor_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del cursor_rows
+    print('rows: %s' % n)
+    print('  dict model : %8.1f KB (+%.1f KB cursor dicts)  %.1f ms' % (dict_size / 1024, cursor_size / 1024, dict_time * 1000))
+    print('  compact row: %8.1f KB  %.1f ms' % (row_size / 1024, row_time * 1000))
+    print('  saved      : %.0f%% of model memory' % (100.0 * (dict_size - row_size) / dict_size))
+
+#InnoDB页的大小，以及每条索引记录除了键之外的开销(记录头、事务id等，粗略估计)
+PAGE_SIZE = 16384
+RECORD_OVERHEAD = 13
+
+#按插入顺序把键放进一个只有叶子页的b+树，返回(页数, 中间页分裂的次数)：键有序时总是追加到最后一页，页是满的；
+#键无序时插到中间的页，页分裂成两个半满的页
+def simulate_index(keys, key_size):
+    per_page = PAGE_SIZE // (key_size + RECORD_OVERHEAD)
+    firsts, pages, splits = [], [], 0
+    for k in keys:
+        i = max(bisect.bisect_right(firsts, k) - 1, 0)
+        if not pages:
+            firsts.append(k)
+            pages.append([k])
+            continue
+        page = pages[i]
+        bisect.insort(page, k)
+        firsts[i] = page[0]
+        if len(page) > per_page:
+            #追加到最后一页时像InnoDB一样开新页，否则对半分
+            if i == len(pages) - 1 and page[-1] == k:
+                cut = per_page
+            else:
+                cut = len(page) // 2
+                splits += 1
+            pages.insert(i + 1, page[cut:])
+            firsts.insert(i + 1, page[cut])
+            del page[cut:]
+    return len(pages), splits
+
+#比较next_id()(varchar(50))和KeyField(bigint / binary(16))：生成速度、插入主键索引的页分裂、
+#以及Comment的主键和两个包含主键的二级索引(blog_id, created_at)的大小。没有连接数据库，
+#插入的开销用页数和页分裂来估计：每一页都要写盘，中间页分裂还要多写一页并留下半满的页
+def bench_ids(n):
+    candidates = [
+        ('next_id varchar(50)', next_id, 51),
+        ('KeyField bigint', orm.IdGenerator(worker=1).next, 8),
+        ('KeyField binary(16)', orm.ids.next128, 16),
+    ]
+    print('ids: %s' % n)
+    for name, generate, size in candidates:
+        start = time.perf_counter()
+        keys = [generate() for i in range(n)]
+        elapsed = time.perf_counter() - start
+        #多个进程同时插入：4个worker的id交错到达
+        arrived = [k for group in zip(*[keys[i::4] for i in range(4)]) for k in group]
+        pages, splits = simulate_index(arrived, size)
+        #二级索引的每条记录都带着主键：blog_id索引存外键+主键，created_at索引存8字节的real+主键
+        secondary = n * (2 * size + 2 * RECORD_OVERHEAD + 8)
+        print('  %-20s %9.0f ids/s  %6s pages  %6s splits  primary %8.1f KB  secondary %8.1f KB' % (
+            name, n / elapsed, pages, splits, pages * PAGE_SIZE / 1024, secondary / 1024))
+
+#比较三种从数据库的行创建model的方式的耗时：DictCursor的dict + cls(**r)、dict + cls.load(r)、
+#tuple游标 + 生成的hydrate函数。DictCursor为每一行创建dict的时间也算在前两种里面
+def bench_hydrate(n=100000):
+    rows = fake_rows(n)
+    names = (Comment.__primary_key__,) + tuple(Comment.__fields__)
+    def cursor_dicts(rs):
+        return [dict(zip(names, r)) for r in rs]
+    candidates = [
+        ('dict + cls(**r)', lambda rs: [Comment(**r) for r in cursor_dicts(rs)]),
+        ('dict + cls.load(r)', lambda rs: [Comment.load(r) for r in cursor_dicts(rs)]),
+        ('tuple + __hydrate__', Comment.__hydrate__),
+    ]
+    print('hydrate: %s rows' % n)
+    baseline = None
+    for name, build in candidates:
+        best = None
+        for i in range(5):
+            gc.collect()
+            start = time.perf_counter()
+            objs = build(rows)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            del objs
+        baseline = baseline or best
+        print('  %-20s %8.1f ms  %5.2fx' % (name, best * 1000, baseline / best))
+
+#markdown2的linear-spans：先用随机生成的语料检查和正则的输出完全一致，再比较病态输入下两者的耗时
+SPAN_CORPUS = ['*', '_', '**', '__', '`', '``', ' ', '\t', '\n', '\n\n', 'a', 'word', '\\', '- ', '# ', '> ', '[a](b)', '<b>', '&']
+
+def check_spans(n):
+    rnd = random.Random(0)
+    md = markdown2.Markdown()
+    #只比较这一步的结果，代码的内容不用编码
+    md._encode_code = lambda c: '[%s]' % c
+    for i in range(n):
+        text = ''.join(rnd.choice(SPAN_CORPUS) for j in range(rnd.randint(0, 30)))
+        cases = [
+            (md._strong_re.sub(r'<strong>\2</strong>', text), markdown2._sub_strong_linear(text, '*_')),
+            (md._em_re.sub(r'<em>\2</em>', text), markdown2._sub_em_linear(text, '*_')),
+            (md._code_friendly_strong_re.sub(r'<strong>\1</strong>', text), markdown2._sub_strong_linear(text, '*')),
+            (md._code_friendly_em_re.sub(r'<em>\1</em>', text), markdown2._sub_em_linear(text, '*')),
+            (md._code_span_re.sub(md._code_span_sub, text), md._do_code_spans_linear(text)),
+        ]
+        for expected, got in cases:
+            if expected != got:
+                raise AssertionError('linear-spans differs on %r: %r != %r' % (text, got, expected))
+    #整篇文档
+    for extras in (None, ['code-friendly'], ['fenced-code-blocks']):
+        for i in range(n // 100):
+            text = ''.join(rnd.choice(SPAN_CORPUS) for j in range(300))
+            if markdown2.Markdown(extras=extras).convert(text) != markdown2.Markdown(extras=(extras or []) + ['linear-spans']).convert(text):
+                raise AssertionError('linear-spans differs on document %r' % text)
+
+def bench_spans(n=20000):
+    check_spans(n)
+    print('spans: %s random inputs render the same with and without linear-spans' % n)
+    inputs = [
+        ('unmatched *', lambda k: '*a ' * k),
+        ('unmatched _', lambda k: '_a ' * k),
+        ('unmatched **', lambda k: '**a ' * k),
+        #一个很长的反引号串：串中每个位置都会作为开始的反引号，向后找同样长度的反引号一直找到结尾
+        ('backtick run', lambda k: '`' * k + ' a' * k),
+    ]
+    for name, make in inputs:
+        for k in (1000, 2000, 4000):
+            text = make(k)
+            times = []
+            for extras in (None, ['linear-spans']):
+                start = time.perf_counter()
+                markdown2.Markdown(extras=extras).convert(text)
+                times.append(time.perf_counter() - start)
+            print('  %-14s %6s chars  regex %8.1f ms  linear %6.1f ms' % (name, len(text), times[0] * 1000, times[1] * 1000))
+
+#语句超时之后连接池要能恢复：用aiomysql真正的Pool(maxsize=1)，只把网络连接换成假的，第一个连接上的语句一直卡住，
+#超时关闭这个连接之后，排队等连接的查询应该马上拿到一个新建的连接，而不是等到自己超时
+class FakeReader(object):
+    eof_received = False
+
+    def at_eof(self):
+        return False
+
+    def exception(self):
+        return None
+
+class FakeCursor(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    #和aiomysql一样，cursor()既可以await也可以async with
+    def __await__(self):
+        return self
+        yield
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, sql, args=None):
+        if self._conn.hang:
+            await asyncio.sleep(3600)
+
+    async def fetchall(self):
+        return [(self._conn.thread_id(),)]
+
+    async def close(self):
+        pass
+
+class FakeConnection(object):
+    count = 0
+
+    def __init__(self):
+        FakeConnection.count += 1
+        self._id = FakeConnection.count
+        #只有第一个连接会卡住
+        self.hang = self._id == 1
+        self.closed = False
+        self._reader = FakeReader()
+
+    def thread_id(self):
+        return self._id
+
+    def cursor(self, cls=None):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return False
+
+    def close(self):
+        self.closed = True
+
+    async def ensure_closed(self):
+        self.closed = True
+
+async def check_pool():
+    async def connect(**kw):
+        return FakeConnection()
+    #连接池的连接和_cancel()发KILL用的连接都换成假连接
+    aiomysql.pool.connect = aiomysql.connect = connect
+    await orm.create_pool(None, user='bench', password='', db='bench', minsize=1, maxsize=1)
+    stuck = asyncio.ensure_future(orm.select('select 1', [], raw=True, timeout=0.1))
+    await asyncio.sleep(0)
+    waiter = asyncio.ensure_future(orm.select('select 2', [], raw=True, timeout=5))
+    try:
+        await stuck
+        raise AssertionError('the stuck statement did not time out')
+    except orm.QueryTimeoutError:
+        pass
+    start = time.perf_counter()
+    try:
+        rs = await asyncio.wait_for(waiter, 2)
+    except asyncio.TimeoutError:
+        raise AssertionError('waiter still blocked after a timed out statement: %s' % orm.pool_stats()['pools'])
+    print('pool: waiter got connection %s %.1f ms after the timeout, pool %s' % (rs[0][0], (time.perf_counter() - start) * 1000, dict(orm.pool_stats()['pools']['primary'])))
+
+def bench_pool():
+    asyncio.get_event_loop().run_until_complete(check_pool())
+
+BENCHMARKS = {
+    'rows': bench_rows,
+    'ids': bench_ids,
+    'hydrate': bench_hydrate,
+    'spans': bench_spans,
+    'pool': bench_pool,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*map(int, sys.argv[2:]))
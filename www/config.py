@@ -30,7 +30,7 @@ def merge(defaults, override):
     r = {}
     for k, v in defaults.items():
         if k in override:
-            if isinstance(v, dict):
+            if isinstance(v, dict) and isinstance(override[k], dict):
                 r[k] = merge(v, override[k])
             else:
                 r[k] = override[k]
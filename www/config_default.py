@@ -13,7 +13,33 @@ configs = {
         'port': 3306,
         'user': 'lucas',
         'password': '120788',
-        'db': 'awesome'
+        'db': 'awesome',
+        #只读副本的连接参数列表，例如：[{'host': '127.0.0.2'}]，没有写的参数沿用主库的
+        'replicas': [],
+        #查询结果缓存，None表示不开启，例如：{'ttl': 5, 'maxsize': 1000}
+        'query_cache': None,
+        #合并同时执行的相同查询，只有一条语句发到数据库
+        'single_flight': False,
+        #在内存中维护表的行数，分页时不再每次count(*)；值是和数据库对账的间隔秒数，None表示不开启
+        'row_counters': 60,
+        #一个请求中同一条语句执行超过这个次数时，警告可能的N+1查询
+        'n_plus_one': 5,
+        #慢查询日志：超过threshold秒的语句自动EXPLAIN并记录，同一形状的语句每interval秒最多记录一次；
+        #在config_override.py中设置为None或者{'threshold': None}表示不开启
+        'slow_query': {'threshold': 0.5, 'interval': 60},
+        #请求中的写操作在处理函数返回之后一起提交，每个请求只有一个事务
+        'unit_of_work': False,
+        #一个请求中所有sql语句加起来最多执行的秒数，超时返回503；None表示不限制
+        'request_timeout': 10,
+        #每条sql语句默认最多执行的秒数，None表示只受request_timeout限制
+        'query_timeout': None
+    },
+    #markdown渲染：超过threshold个字符的内容交给进程池渲染，workers为None时等于cpu核数，
+    #进程池中最多max_queue个任务(None表示workers * 4)，满了之后调用者排队等待
+    'render': {
+        'threshold': 16384,
+        'workers': None,
+        'max_queue': None
     },
     'session': {
         'secret': 'Awesome'
@@ -2,12 +2,14 @@
 # -*- coding: utf-8 -*-
 ' url handlers and api handlers'
 import re, time, json, logging, hashlib, base64, asyncio
-import markdown2
 
 from aiohttp import web
 from coroweb import get, post
-from apis import Page, APIValueError, APIResourceNotFoundError, APIPermissionError, APIError
+from apis import Page, CursorPage, decode_cursor, APIValueError, APIResourceNotFoundError, APIPermissionError, APIError
+import orm
 from models import User, Comment, Blog, next_id
+import render
+from render import render_blog, blog_html
 from config import configs
 
 COOKIE_NAME = 'awesession'
@@ -29,6 +31,22 @@ def get_page_index(page_str):
         p = 1
     return p
 
+#把?fields=name,summary转换成要查询的列，None表示所有列
+def get_columns(model, fields):
+    if not fields:
+        return None
+    columns = [f.strip() for f in fields.split(',') if f.strip()]
+    for f in columns:
+        if f not in model.__mappings__:
+            raise APIValueError('fields', 'Invalid field: %s' % f)
+    return columns
+
+#游标分页：按(created_at, id)定位翻页，深分页不再需要mysql扫描并丢弃offset之前的所有行
+async def get_cursor_page(model, cursor, page_size=10, columns=None):
+    key, before = decode_cursor(cursor)
+    items = await model.findAfter(key, orderBy='created_at desc', limit=page_size + 1, before=before, columns=columns)
+    return CursorPage(items, page_size, key, before), items
+
 #把用户和cookie的持续时间通过加密函数转换成一个字符串
 def user2cookie(user, max_age):
     '''
@@ -83,7 +101,8 @@ async def index(*, page='1'):
     if num == 0:
         blogs = []
     else:
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+        #首页只显示标题和摘要，不需要查询正文
+        blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit), columns=['name', 'summary', 'created_at'])
     return {
         '__template__': 'blogs.html',
         'page': page,
@@ -97,7 +116,8 @@ async def get_blog(id):
     comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
     for c in comments:
         c.html_content = text2html(c.content)
-    blog.html_content = markdown2.markdown(blog.content)
+    #html在写blog的时候已经渲染好了
+    blog.html_content = await blog_html(blog)
     return {
         '__template__': 'blog.html',
         'blog': blog,
@@ -239,27 +259,39 @@ async def api_register_user(*, email, name, passwd):
     return r
 #获取所有用户
 @get('/api/users')
-async def api_get_users(*, page=1): 
+async def api_get_users(*, page=1, cursor=None, fields=None): 
+    columns = get_columns(User, fields)
+    if cursor is not None:
+        p, users = await get_cursor_page(User, cursor, columns=columns)
+        for u in users:
+            if 'passwd' in u:
+                u.passwd = '******'
+        return dict(page=p, users=users)
     page_index = get_page_index(page)
     num = await User.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, users=())
-    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), columns=columns)
     for u in users:
-        u.passwd = '******'
+        if 'passwd' in u:
+            u.passwd = '******'
     return dict(page=p, users=users) 
 
 #Blog module APIS
 #根据页码获取博客
 @get('/api/blogs')
-async def api_blogs(*, page='1'):
+async def api_blogs(*, page='1', cursor=None, fields=None):
+    columns = get_columns(Blog, fields)
+    if cursor is not None:
+        p, blogs = await get_cursor_page(Blog, cursor, columns=columns)
+        return dict(page=p, blogs=blogs)
     page_index = get_page_index(page)
     num =  await Blog.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), columns=columns)
     return dict(page=p, blogs=blogs)
 #根据blog's id获取blog
 @get('/api/blogs/{id}')
@@ -277,6 +309,7 @@ async def api_create_blog(request, *, name, summary, content):
     if not content or not content.strip():
         raise APIValueError('content', 'content cannot be empty.')
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
+    await render_blog(blog)
     await blog.save()
     return blog
 #根据blog's id 更新blog
@@ -293,6 +326,7 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.name = name.strip()
     blog.summary = summary.strip()
     blog.content =  content.strip()
+    await render_blog(blog)
     await blog.update()
     return blog
 #删除blog
@@ -308,13 +342,17 @@ async def api_delete_blog(request, *, id):
 #comment module APIS
 #获取所有comments
 @get('/api/comments')
-async def api_get_comments(*, page='1'):
+async def api_get_comments(*, page='1', cursor=None, fields=None):
+    columns = get_columns(Comment, fields)
+    if cursor is not None:
+        p, comments = await get_cursor_page(Comment, cursor, columns=columns)
+        return dict(page=p, comments=comments)
     page_index = get_page_index(page)
     num = await Comment.findNumber('count(id)')
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, comments=())
-    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit), columns=columns)
     return dict(page=p, comments=comments)
 #根据blog id新建comment
 @post('/api/blogs/{id}/comments')
@@ -340,3 +378,15 @@ async def api_delete_comments(id, request):
     await comment.remove()
     return dict(id=id)
 
+#monitor APIS
+#数据库连接池的监控数据：获取连接的等待时间、占用时间的直方图，每个连接池的使用情况和可能泄漏的连接
+@get('/api/metrics/db')
+async def api_db_metrics(request):
+    check_admin(request)
+    return orm.pool_stats()
+
+#markdown渲染服务的监控数据：进程池的队列深度、等待的调用者数和渲染缓存的命中率
+@get('/api/metrics/render')
+async def api_render_metrics(request):
+    check_admin(request)
+    return render.service.stats()
@@ -60,6 +60,9 @@ see <https://github.com/trentm/python-markdown2/wiki/Extras> for details):
   blocks.
 * link-patterns: Auto-link given regex patterns in text (e.g. bug number
   references, revision number references).
+* linear-spans: Find code spans, strong and em with linear-time scanners
+  instead of the backtracking regexes. The output is the same; use it for
+  untrusted input with many unmatched '`', '*' or '_'.
 * smarty-pants: Replaces ' and " with curly quotation marks or curly
   apostrophes.  Replaces --, ---, ..., and . . . with en dashes, em dashes,
   and ellipses.
@@ -88,12 +91,15 @@ from pprint import pprint, pformat
 import re
 import logging
 try:
-    from hashlib import md5
+    from hashlib import md5, sha256
 except ImportError:
     from md5 import md5
+    sha256 = None
 import optparse
 from random import random, randint
 import codecs
+import threading
+from collections import OrderedDict
 
 
 #---- Python version compat
@@ -166,10 +172,119 @@ def markdown_path(path, encoding="utf-8",
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
              use_file_vars=False):
-    return Markdown(html4tags=html4tags, tab_width=tab_width,
-                    safe_mode=safe_mode, extras=extras,
-                    link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+    # Renders with `link_patterns` are not cached: the patterns and their
+    # replacements (possibly callables) can't be reliably keyed.
+    cache = render_cache
+    if cache is None or link_patterns:
+        return Markdown(html4tags=html4tags, tab_width=tab_width,
+                        safe_mode=safe_mode, extras=extras,
+                        link_patterns=link_patterns,
+                        use_file_vars=use_file_vars).convert(text)
+    key = cache.key(text, html4tags, tab_width, safe_mode, extras,
+                    use_file_vars)
+    html = cache.get(key)
+    if html is None:
+        html = Markdown(html4tags=html4tags, tab_width=tab_width,
+                        safe_mode=safe_mode, extras=extras,
+                        use_file_vars=use_file_vars).convert(text)
+        cache.put(key, html)
+    return html
+
+
+class RenderCache(object):
+    """A thread-safe LRU cache of `markdown()` results bounded by total size.
+
+    Entries are keyed on a SHA-256 digest of the source text plus the
+    options that affect the output (`extras`, `safe_mode`, `tab_width`,
+    `html4tags`, `use_file_vars`), so a repeated render of the same
+    content costs a hash and a dict lookup instead of a full
+    `Markdown.convert()`. The least recently used entries are evicted
+    once the memory held by the cached HTML strings exceeds `max_bytes`;
+    a single result larger than `max_bytes` is never cached.
+
+        >>> cache = RenderCache(max_bytes=1024)
+        >>> key = cache.key(u"*boo!*", False, 4, None, None, False)
+        >>> cache.get(key) is None
+        True
+        >>> cache.put(key, u"<p><em>boo!</em></p>\\n")
+        >>> print(cache.get(key))
+        <p><em>boo!</em></p>
+        <BLANKLINE>
+        >>> cache.stats()["hits"], cache.stats()["misses"]
+        (1, 1)
+    """
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, text, html4tags, tab_width, safe_mode, extras,
+            use_file_vars):
+        if extras is None:
+            extras = ()
+        elif isinstance(extras, dict):
+            extras = tuple(sorted((k, repr(v)) for k, v in extras.items()))
+        else:
+            extras = tuple(sorted((e, repr(None)) for e in extras))
+        if safe_mode is True:
+            safe_mode = "replace"
+        if not isinstance(text, bytes):
+            text = text.encode("utf-8")
+        return (sha256(text).digest(), extras, safe_mode, tab_width,
+                bool(html4tags), bool(use_file_vars))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._move_to_end(key, entry)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, html):
+        # The size of an entry is the memory held by the HTML string (1 to
+        # 4 bytes per character, 2 for CJK text) plus a rough fixed size
+        # for the key.
+        size = sys.getsizeof(html) + 64
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (html, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted[1]
+
+    def _move_to_end(self, key, entry):
+        try:
+            self._entries.move_to_end(key)
+        except AttributeError:  # Python 2's OrderedDict has no move_to_end
+            del self._entries[key]
+            self._entries[key] = entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._entries), bytes=self.bytes,
+                    max_bytes=self.max_bytes, hits=self.hits,
+                    misses=self.misses,
+                    ratio=(float(self.hits) / total if total else 0.0))
+
+# The cache used by `markdown()`. Set to None to disable caching, or to a
+# new `RenderCache(max_bytes=...)` to change its size.
+render_cache = RenderCache() if sha256 is not None else None
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -1660,10 +1775,55 @@ class Markdown(object):
         ''', re.X | re.S)
 
     def _code_span_sub(self, match):
-        c = match.group(2).strip(" \t")
+        return self._code_span_html(match.group(2))
+
+    def _code_span_html(self, c):
+        c = c.strip(" \t")
         c = self._encode_code(c)
         return "<code>%s</code>" % c
 
+    _backtick_run_re = re.compile(r'`+')
+
+    def _do_code_spans_linear(self, text):
+        """Same result as `self._code_span_re.sub(...)` in linear time.
+
+        The regex tries every backtick as an opener: the opening run is
+        the rest of the backtick run it starts in (m backticks), and the
+        closer is the next *maximal* run of exactly m backticks after at
+        least one character of code. Maximal runs are grouped by length
+        and every opener only looks further right than the previous one,
+        so each group is walked once with a cursor.
+        """
+        runs = [(m.start(), m.end())
+                for m in self._backtick_run_re.finditer(text)]
+        starts_by_length = {}
+        for start, end in runs:
+            starts_by_length.setdefault(end - start, []).append(start)
+        cursors = {}
+        chunks = []
+        pos = 0
+        for start, end in runs:
+            i = max(start, pos)
+            while i < end:
+                # (?<!\\): only the first backtick of a run can follow a
+                # backslash.
+                if i == 0 or text[i-1] != '\\':
+                    m = end - i
+                    starts = starts_by_length[m] if m in starts_by_length else ()
+                    k = cursors.get(m, 0)
+                    while k < len(starts) and starts[k] <= end:
+                        k += 1
+                    cursors[m] = k
+                    if k < len(starts):
+                        close = starts[k]
+                        chunks.append(text[pos:i])
+                        chunks.append(self._code_span_html(text[end:close]))
+                        pos = close + m
+                        break
+                i += 1
+        chunks.append(text[pos:])
+        return ''.join(chunks)
+
     def _do_code_spans(self, text):
         #   *   Backtick quotes are used for <code></code> spans.
         #
@@ -1687,6 +1847,8 @@ class Markdown(object):
         #       Turns to:
         #
         #         ... type <code>`bar`</code> ...
+        if "linear-spans" in self.extras:
+            return self._do_code_spans_linear(text)
         return self._code_span_re.sub(self._code_span_sub, text)
 
     def _encode_code(self, text):
@@ -1714,7 +1876,11 @@ class Markdown(object):
     _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
     def _do_italics_and_bold(self, text):
         # <strong> must go first:
-        if "code-friendly" in self.extras:
+        if "linear-spans" in self.extras:
+            delims = "*" if "code-friendly" in self.extras else "*_"
+            text = _sub_strong_linear(text, delims)
+            text = _sub_em_linear(text, delims)
+        elif "code-friendly" in self.extras:
             text = self._code_friendly_strong_re.sub(r"<strong>\1</strong>", text)
             text = self._code_friendly_em_re.sub(r"<em>\1</em>", text)
         else:
@@ -1990,6 +2156,111 @@ class MarkdownWithExtras(Markdown):
 
 #---- internal support functions
 
+_emphasis_run_re = re.compile(r"[*_]+")
+
+def _sub_strong_linear(text, delims):
+    """Same result as `_strong_re.sub(r"<strong>\\2</strong>", text)` (or
+    `_code_friendly_strong_re` when `delims` is "*") in linear time.
+
+    For an opener `dd` at i (followed by a non-space), the regex's lazy
+    `.+?` stops at the first run of [*_] characters that reaches past i+2,
+    and the greedy `[*_]*` then closes on the *last* `dd` in that run. The
+    run containing i+3 closes it if its last `dd` starts at or after i+3;
+    any later run closes it if its last `dd` is not at the run start
+    right after whitespace (the `(?<=\\S)` check). Those later runs are
+    found with one cursor per delimiter that only moves forward.
+    """
+    runs = [(m.start(), m.end()) for m in _emphasis_run_re.finditer(text)]
+    last_pair = {}
+    valid = {}
+    for d in delims:
+        pair = d + d
+        last = last_pair[d] = [text.rfind(pair, s, e) for s, e in runs]
+        valid[d] = [r for r, (s, e) in enumerate(runs)
+                    if last[r] != -1 and
+                       last[r] >= s + (s > 0 and text[s-1].isspace())]
+    cursors = dict((d, 0) for d in delims)
+    n = len(text)
+    chunks = []
+    pos = 0
+    r = 0
+    while r < len(runs):
+        s, e = runs[r]
+        i = max(s, pos)
+        matched = False
+        while i < e - 1:
+            d = text[i]
+            if d in delims and text[i+1] == d and i + 2 < n \
+                    and not text[i+2].isspace():
+                close = -1
+                # The run containing i+3: this one or the next.
+                if i + 3 < e:
+                    inner = r
+                elif r + 1 < len(runs) and runs[r+1][0] == i + 3:
+                    inner = r + 1
+                else:
+                    inner = None
+                if inner is not None and last_pair[d][inner] >= i + 3:
+                    close = last_pair[d][inner]
+                else:
+                    candidates = valid[d]
+                    k = cursors[d]
+                    while k < len(candidates) and runs[candidates[k]][0] <= i + 3:
+                        k += 1
+                    cursors[d] = k
+                    if k < len(candidates):
+                        close = last_pair[d][candidates[k]]
+                if close != -1:
+                    chunks.append(text[pos:i])
+                    chunks.append("<strong>%s</strong>" % text[i+2:close])
+                    pos = close + 2
+                    matched = True
+                    break
+            i += 1
+        if matched:
+            while r < len(runs) and runs[r][1] <= pos:
+                r += 1
+        else:
+            r += 1
+    chunks.append(text[pos:])
+    return ''.join(chunks)
+
+def _sub_em_linear(text, delims):
+    """Same result as `_em_re.sub(r"<em>\\2</em>", text)` (or
+    `_code_friendly_em_re` when `delims` is "*") in linear time.
+
+    An opener `d` followed by a non-space closes on the first `d` at least
+    two characters further on that does not follow whitespace; those
+    closers are collected up front and walked with one cursor per
+    delimiter.
+    """
+    n = len(text)
+    positions = [m.start() for m in
+                 re.finditer("[%s]" % re.escape(delims), text)]
+    closers = dict((d, []) for d in delims)
+    for j in positions:
+        if j > 0 and not text[j-1].isspace():
+            closers[text[j]].append(j)
+    cursors = dict((d, 0) for d in delims)
+    chunks = []
+    pos = 0
+    for i in positions:
+        if i < pos or i + 1 >= n or text[i+1].isspace():
+            continue
+        d = text[i]
+        candidates = closers[d]
+        k = cursors[d]
+        while k < len(candidates) and candidates[k] < i + 2:
+            k += 1
+        cursors[d] = k
+        if k < len(candidates):
+            close = candidates[k]
+            chunks.append(text[pos:i])
+            chunks.append("<em>%s</em>" % text[i+1:close])
+            pos = close + 1
+    chunks.append(text[pos:])
+    return ''.join(chunks)
+
 class UnicodeWithAttrs(unicode):
     """A subclass of unicode used for the return value of conversion to
     possibly attach some attributes. E.g. the "toc_html" attribute when
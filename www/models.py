@@ -5,7 +5,7 @@
 Models for user, blog, comment
 '''
 import time, uuid
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, IntegerField, FloatField, TextField
 
 #Generate a random id(length=15) using the 'time' module and 'uuid' module
 def next_id():
@@ -16,12 +16,12 @@ class User(Model):
     __table__ = 'users'
     #Class attributes(Not instance attributes)
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50')
-    passwd = StringField(ddl='varchar(50')
+    email = StringField(ddl='varchar(50)', unique=True)
+    passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 class Blog(Model):
     __table__ = 'blogs'
@@ -33,16 +33,23 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    #The html rendered from content when the blog is written, and the render.RENDERER_VERSION that produced it
+    html_content = TextField(default='')
+    renderer_version = IntegerField()
+    created_at = FloatField(default=time.time, index=True)
 
 class Comment(Model):
     __table__ = 'comments'
+    #Keep the number of comments per blog in the orm row counters
+    __counters__ = ('blog_id',)
+    #Comments of a blog are loaded by blog_id and ordered by created_at
+    __indexes__ = [('blog_id', 'created_at')]
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
     user_id = StringField(ddl='varchar(50)')
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
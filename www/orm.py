@@ -1,22 +1,353 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import asyncio, logging
+import asyncio, logging, time, re, json, contextlib, contextvars, collections, os, threading
 import aiomysql
 
 #python 的全局变量定义的时候直接在函数外定义，不用global关键字。global关键子用于在函数内部访问或者修改全局变量时使用
 __pool = None
 
+#主库的连接池；类的方法中不能直接写__pool，会被改名成_类名__pool
+def primary_pool():
+    return __pool
+
 #在控制台打印出sql的信息
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
-#创建数据库连接池，这样可以提升效率，最大效率的利用已有的链接。比如：如果不用连接池，每一个请求都建立一个数据库连接，io操作后
-#再关闭，但是用了连接池之后，一旦有需要获得数据库连接时候，直接从连接池里取，连接池里如果没有连接才会创建。
-async def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
-    #读取全局变量的申明
-    global __pool 
-    __pool = await aiomysql.create_pool(
+
+#已经编译好的sql：占位符'?'已经替换成了驱动需要的'%s'，select()和execute()拿到后可以直接交给游标执行
+class CompiledSQL(str):
+    pass
+
+def compile_sql(sql):
+    if isinstance(sql, CompiledSQL):
+        return sql
+    return CompiledSQL(sql.replace('?', '%s'))
+
+#sql语句缓存：以查询的"形状"(model, 查询类型, where, orderBy, limit的形式)为key，保存最终交给驱动的sql，
+#这样findAll/findNumber在热路径上只需要绑定参数，不用每次都拼接字符串再替换占位符
+class StatementCache(object):
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._statements = dict()
+
+    def get(self, key, build):
+        sql = self._statements.get(key)
+        if sql is not None:
+            self.hits += 1
+            return sql
+        self.misses += 1
+        sql = compile_sql(build())
+        #where子句如果是动态拼出来的，形状会无限多，超过上限之后就不再缓存，只编译
+        if len(self._statements) < self.maxsize:
+            self._statements[key] = sql
+        return sql
+
+    def clear(self):
+        self._statements.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return dict(size=len(self._statements), hits=self.hits, misses=self.misses)
+
+statements = StatementCache()
+
+#查询结果缓存：以sql和参数为key，带过期时间和LRU容量上限；每一条缓存都标记了它读取的表，
+#Model.save/update/remove写某张表的时候，这张表相关的缓存全部失效
+class QueryCache(object):
+
+    _tables_re = re.compile(r'\b(?:from|join)\s+`?(\w+)`?', re.I)
+
+    def __init__(self, ttl=5, maxsize=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        #每次失效都加一，查询期间发生过失效的结果不放进缓存，避免把写之前读到的旧数据放回去
+        self.version = 0
+        self._entries = collections.OrderedDict()
+        self._tags = dict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, sql, rs, version):
+        if version != self.version:
+            return
+        tables = tuple(set(self._tables_re.findall(sql)))
+        self._discard(key)
+        self._entries[key] = (time.monotonic() + self.ttl, rs, tables)
+        for t in tables:
+            self._tags.setdefault(t, set()).add(key)
+        while len(self._entries) > self.maxsize:
+            self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for t in entry[2]:
+                keys = self._tags.get(t)
+                if keys is not None:
+                    keys.discard(key)
+
+    def invalidate(self, table):
+        self.version += 1
+        for key in list(self._tags.pop(table, ())):
+            self._discard(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._tags.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self._entries), hits=self.hits, misses=self.misses, ratio=(self.hits / total if total else 0.0))
+
+#默认不开启，create_pool(query_cache=dict(ttl=..., maxsize=...))开启
+query_cache = None
+
+#合并正在执行的相同查询：sql和参数都相同的select如果已经有一个在执行，后来的调用者等待同一个结果，
+#只有一条语句会发到数据库。和查询缓存不同，结果不会保留，查询结束之后下一次调用会重新查询；
+#写某张表之后，读取这张表的正在执行的查询不再被合并，避免读到写之前的数据
+class SingleFlight(object):
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._flights = dict()
+        self._tags = dict()
+
+    async def do(self, key, sql, run):
+        task = self._flights.get(key)
+        if task is not None:
+            self.followers += 1
+        else:
+            self.leaders += 1
+            #查询在单独的task中执行，发起查询的请求被取消时，其他等待的调用者仍然能拿到结果
+            task = asyncio.ensure_future(run())
+            tables = tuple(set(QueryCache._tables_re.findall(sql)))
+            self._flights[key] = task
+            for t in tables:
+                self._tags.setdefault(t, set()).add(key)
+            task.add_done_callback(lambda t: self._discard(key, task, tables))
+        #返回副本，调用者修改列表不会影响其他调用者
+        return list(await asyncio.shield(task))
+
+    def _discard(self, key, task, tables):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+            for t in tables:
+                keys = self._tags.get(t)
+                if keys is not None:
+                    keys.discard(key)
+        #没有调用者等待的时候也要取出异常，避免'exception was never retrieved'的警告
+        if not task.cancelled():
+            task.exception()
+
+    def invalidate(self, table):
+        for key in self._tags.pop(table, ()):
+            self._flights.pop(key, None)
+
+    def stats(self):
+        return dict(in_flight=len(self._flights), leaders=self.leaders, followers=self.followers)
+
+#默认不开启，create_pool(single_flight=True)开启
+single_flight = None
+
+#行数计数器：在内存中维护每张表的总行数，以及按__counters__中声明的列分组的行数(例如每篇blog的评论数)，
+#key是(model, 列名, 列的值)，整张表的key是(model, None, None)。save/remove时增减，后台定时和数据库对账，
+#这样分页时的findNumber('count(id)')不用每次都让InnoDB扫描整个索引
+class RowCounters(object):
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        #每次增减都加一，统计期间有增减的结果不覆盖内存中的计数
+        self.version = 0
+        self._counts = dict()
+
+    def get(self, key):
+        return self._counts.get(key)
+
+    def set(self, key, n, version):
+        if version != self.version:
+            return
+        if key in self._counts or len(self._counts) < self.maxsize:
+            self._counts[key] = n
+
+    def add(self, key, delta):
+        self.version += 1
+        if key in self._counts:
+            self._counts[key] += delta
+
+    def keys(self):
+        return list(self._counts.keys())
+
+    def clear(self):
+        self._counts.clear()
+
+#默认不开启，create_pool(row_counters=对账间隔秒数)开启
+row_counters = None
+#直方图：按上限分桶统计耗时(秒)，桶的计数是累计的，和prometheus的histogram一样
+class Histogram(object):
+
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self._counts[i] += 1
+                return
+        self._counts[-1] += 1
+
+    def snapshot(self):
+        cumulative, total = [], 0
+        for bound, n in zip(self.buckets + ('+Inf',), self._counts):
+            total += n
+            cumulative.append((str(bound), total))
+        return dict(count=self.count, sum=self.sum, max=self.max, buckets=collections.OrderedDict(cumulative))
+
+#连接池的监控数据：获取连接的等待时间、连接被占用的时间、正在排队等待连接的数量，以及占用超过leak_threshold秒的连接(可能泄漏)
+class PoolMetrics(object):
+
+    def __init__(self, leak_threshold=5.0):
+        self.leak_threshold = leak_threshold
+        self.acquire_wait = Histogram()
+        self.hold = Histogram()
+        self.waiting = 0
+        self.leaks = 0
+        #正在被占用的连接 ==> (获取的时间, 占用它的task)
+        self._held = dict()
+
+    def held(self):
+        now = time.monotonic()
+        return [dict(holder=holder, seconds=now - start) for start, holder in self._held.values() if now - start > self.leak_threshold]
+
+pool_metrics = PoolMetrics()
+
+#正在使用的连接 ==> 它所属的连接池
+_owners = dict()
+
+#从连接池获取连接的上下文管理器，用来代替pool.get()，同时记录等待和占用的时间
+class acquire(object):
+
+    __slots__ = ('_pool', '_conn', '_start')
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    async def __aenter__(self):
+        start = time.monotonic()
+        pool_metrics.waiting += 1
+        try:
+            end = _deadline.get()
+            if end is None:
+                self._conn = await self._pool.acquire()
+            else:
+                #请求有截止时间的时候，排队等连接也不能超过截止时间
+                try:
+                    self._conn = await asyncio.wait_for(self._pool.acquire(), end - start)
+                except asyncio.TimeoutError:
+                    raise QueryTimeoutError('timed out waiting for a database connection')
+        finally:
+            pool_metrics.waiting -= 1
+        _owners[id(self._conn)] = self._pool
+        self._start = time.monotonic()
+        pool_metrics.acquire_wait.observe(self._start - start)
+        task = asyncio.current_task()
+        pool_metrics._held[id(self._conn)] = (self._start, task.get_name() if task is not None else None)
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        held = time.monotonic() - self._start
+        pool_metrics._held.pop(id(self._conn), None)
+        _owners.pop(id(self._conn), None)
+        pool_metrics.hold.observe(held)
+        if held > pool_metrics.leak_threshold:
+            pool_metrics.leaks += 1
+            logging.warning('database connection held for %.3fs (threshold %.3fs)' % (held, pool_metrics.leak_threshold))
+        await self._pool.release(self._conn)
+        #aiomysql归还已经关闭的连接(比如语句超时被_cancel关闭)时不会唤醒排队的acquire()，
+        #这里唤醒一个等待者，让它新建连接补上，否则连接池会一直少一个连接，排队的请求只能等到超时
+        if self._conn.closed:
+            await self._pool._wakeup()
+
+#连接池的监控数据快照，HTTP接口或者日志可以直接输出
+def pool_stats():
+    pools = collections.OrderedDict()
+    for name, pool in [('primary', __pool)] + [(r.name, r.pool) for r in __replicas]:
+        if pool is not None:
+            pools[name] = dict(size=pool.size, free=pool.freesize, in_use=pool.size - pool.freesize, maxsize=pool.maxsize)
+    return dict(
+        pools=pools,
+        waiting=pool_metrics.waiting,
+        acquire_wait=pool_metrics.acquire_wait.snapshot(),
+        hold=pool_metrics.hold.snapshot(),
+        leaks=pool_metrics.leaks,
+        held_too_long=pool_metrics.held(),
+        single_flight=single_flight.stats() if single_flight is not None else None,
+        query_cache=query_cache.stats() if query_cache is not None else None,
+        statements=statements.stats()
+    )
+
+#只读副本：记录每个副本连接池正在执行的查询数和健康状态
+class Replica(object):
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.in_flight = 0
+        self.healthy = True
+
+    def fail(self, e):
+        if self.healthy:
+            logging.warning('replica %s removed from rotation: %s' % (self.name, e))
+        self.healthy = False
+
+__replicas = []
+#连接池 ==> 连接参数，语句超时后需要另外建立一个连接去KILL
+__dsns = dict()
+#每条语句默认最多执行的秒数，None表示没有限制
+__query_timeout = None
+#写之后多少秒内，同一个请求/会话的读操作仍然走主库，避免读到副本上还没同步的旧数据
+__read_your_writes = 1.0
+#没有开启read_scope的时候(比如脚本)，用全局的最近一次写的时间来判断
+__last_write = 0.0
+#会话标识 ==> 这个会话最近一次写之后，读操作必须走主库直到这个时间
+__session_writes = dict()
+#当前请求的读写范围：[会话标识, 最近一次写之后读走主库直到这个时间]
+_write_scope = contextvars.ContextVar('orm_write_scope', default=None)
+
+#创建连接池，并记录它的连接参数
+async def _create_pool(loop, kw):
+    args = _pool_args(loop, kw)
+    pool = await aiomysql.create_pool(**args)
+    __dsns[id(pool)] = dict((k, args[k]) for k in ('host', 'port', 'user', 'password', 'db', 'charset'))
+    return pool
+
+def _pool_args(loop, kw):
+    return dict(
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -29,41 +360,583 @@ async def create_pool(loop, **kw):
         loop=loop
     )
 
+#创建数据库连接池，这样可以提升效率，最大效率的利用已有的链接。比如：如果不用连接池，每一个请求都建立一个数据库连接，io操作后
+#再关闭，但是用了连接池之后，一旦有需要获得数据库连接时候，直接从连接池里取，连接池里如果没有连接才会创建。
+#replicas是只读副本的连接参数列表(没有写的参数沿用主库的)，select()会分散到副本上执行，execute()始终走主库
+async def create_pool(loop, **kw):
+    logging.info('create database connection pool...')
+    #读取全局变量的申明
+    global __pool, __replicas, __read_your_writes, __query_timeout, query_cache, single_flight, row_counters, slow_log
+    __pool = await _create_pool(loop, kw)
+    __query_timeout = kw.get('query_timeout', None)
+    pool_metrics.leak_threshold = kw.get('leak_threshold', 5.0)
+    #slow_query为None或者threshold为None时不开启
+    if kw.get('slow_query', None) and kw['slow_query'].get('threshold', 0.5) is not None:
+        slow_log = SlowQueryLog(**kw['slow_query'])
+    if kw.get('query_cache', None):
+        query_cache = QueryCache(**kw['query_cache'])
+    if kw.get('single_flight', False):
+        single_flight = SingleFlight()
+    if kw.get('row_counters', None):
+        row_counters = RowCounters()
+        asyncio.ensure_future(reconcile_counters(kw['row_counters']))
+    __read_your_writes = kw.get('read_your_writes', 1.0)
+    __replicas = []
+    for dsn in kw.get('replicas', None) or []:
+        logging.info('create replica connection pool: %s' % dsn.get('host'))
+        __replicas.append(Replica(dsn.get('host'), await _create_pool(loop, dict(kw, **dsn))))
+    if __replicas:
+        asyncio.ensure_future(check_replicas(kw.get('health_interval', 5)))
+
+#定时检查副本：检查失败的副本从轮询中摘除，恢复之后再加回来
+async def check_replicas(interval):
+    while __replicas:
+        #所有副本同时检查，一个卡住的副本不会拖住其他副本的检查
+        await asyncio.gather(*[_ping(replica, interval) for replica in __replicas])
+        await asyncio.sleep(interval)
+
+#检查一个副本：获取连接和执行select 1都不能超过interval秒；超时的连接先关闭，连接池会丢弃它，不会留给正常的查询
+async def _ping(replica, interval):
+    try:
+        with deadline(interval):
+            async with acquire(replica.pool) as conn:
+                cur = await conn.cursor()
+                try:
+                    await _bounded(conn, cur.execute('select 1'), interval)
+                finally:
+                    if not conn.closed:
+                        await cur.close()
+        if not replica.healthy:
+            logging.info('replica %s back in rotation' % replica.name)
+        replica.healthy = True
+    except Exception as e:
+        replica.fail(e)
+
+#在with块中，写之后的读会在read_your_writes秒内留在主库；session相同的请求之间也是如此。app.py中的中间件为每个请求开启一次
+@contextlib.contextmanager
+def read_scope(session=None):
+    token = _write_scope.set([session, 0.0])
+    try:
+        yield
+    finally:
+        _write_scope.reset(token)
+
+#记录一次写操作
+def _wrote():
+    global __last_write
+    until = time.monotonic() + __read_your_writes
+    scope = _write_scope.get()
+    if scope is None:
+        __last_write = until
+        return
+    scope[1] = until
+    session = scope[0]
+    if session:
+        #顺便清理已经过期的会话，防止字典无限增长
+        if len(__session_writes) > 10000:
+            now = time.monotonic()
+            for k in [k for k, v in __session_writes.items() if v < now]:
+                del __session_writes[k]
+        __session_writes[session] = until
+
+#当前请求(或者会话)刚写过数据库，还在只能读主库的时间窗口里
+def _recently_wrote():
+    now = time.monotonic()
+    scope = _write_scope.get()
+    if scope is None:
+        return __last_write > now
+    return scope[1] > now or bool(scope[0] and __session_writes.get(scope[0], 0.0) > now)
+
+#选择执行读操作的副本：在健康的副本中选正在执行的查询最少的一个；最近写过或者没有可用副本时返回None，即走主库
+def pick_replica():
+    if not __replicas or _recently_wrote():
+        return None
+    replica = None
+    for r in __replicas:
+        if r.healthy and (replica is None or r.in_flight < replica.in_flight):
+            replica = r
+    return replica
+
+#显式事务：事务中所有的select/execute以及Model的方法都复用同一个连接，一起提交或者回滚
+class Transaction(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.savepoints = 0
+        #事务中写过的表，提交之后还要再让查询缓存失效一次
+        self.tables = set()
+        #事务中的行数增减，提交之后才计入计数器
+        self.counts = []
+
+#当前task所在的事务，None表示不在事务中
+_transaction = contextvars.ContextVar('orm_transaction', default=None)
+
+#async with orm.transaction() as tx: 事务绑定在当前task上(contextvars)，嵌套使用时创建savepoint，
+#内层出错只回滚到savepoint。同一个事务的连接不能在多个并发的task中同时使用
+@contextlib.asynccontextmanager
+async def transaction():
+    tx = _transaction.get()
+    if tx is not None:
+        tx.savepoints += 1
+        name = 'sp_%s' % tx.savepoints
+        #回滚到保存点时，块中记录的行数增减也要一起丢掉
+        mark = len(tx.counts)
+        await _execute(tx.conn, 'savepoint %s' % name, ())
+        try:
+            yield tx
+        except BaseException as e:
+            await _execute(tx.conn, 'rollback to savepoint %s' % name, ())
+            del tx.counts[mark:]
+            raise
+        await _execute(tx.conn, 'release savepoint %s' % name, ())
+        return
+    async with acquire(__pool) as conn:
+        await conn.begin()
+        tx = Transaction(conn)
+        token = _transaction.set(tx)
+        try:
+            yield tx
+        except BaseException as e:
+            if not conn.closed:
+                await conn.rollback()
+            raise
+        finally:
+            _transaction.reset(token)
+        await conn.commit()
+        _wrote()
+        for table in tx.tables:
+            invalidate(table)
+        for keys, delta in tx.counts:
+            count_rows(keys, delta)
+
+#让查询缓存和single_flight中读取了这张表的结果失效；在事务中写的表，提交的时候会再失效一次，
+#防止提交之前其他请求又把旧数据放回缓存，或者提交之后还加入提交之前开始的查询
+def invalidate(table):
+    tx = _transaction.get()
+    if tx is not None:
+        tx.tables.add(table)
+    if single_flight is not None:
+        single_flight.invalidate(table)
+    if query_cache is not None:
+        query_cache.invalidate(table)
+
+#增减计数器中的行数，在事务中则等到提交之后再计入
+def count_rows(keys, delta):
+    if row_counters is None:
+        return
+    tx = _transaction.get()
+    if tx is not None:
+        tx.counts.append((keys, delta))
+        return
+    for key in keys:
+        row_counters.add(key, delta)
+
+#定时用count(*)重新统计内存中的每一个计数，修正其他进程的写、被回滚的事务等造成的偏差
+async def reconcile_counters(interval):
+    while row_counters is not None:
+        await asyncio.sleep(interval)
+        for key in row_counters.keys():
+            model, col, value = key
+            try:
+                version = row_counters.version
+                rs = await _read(model._countSQL(col), [] if col is None else [model.dbValue(col, value)], 1, False)
+                row_counters.set(key, rs[0]['_num_'], version)
+            except Exception as e:
+                logging.warning('failed to reconcile row counter %s: %s' % (key, e))
+
+#请求级别的sql追踪：收集一个请求中执行的每条语句的形状、耗时和行数；同一形状的语句执行超过n_plus_one次时
+#输出一次警告，用来发现handlers中的N+1查询
+class QueryTrace(object):
+
+    _in_re = re.compile(r'\(\s*%s(?:\s*,\s*%s)*\s*\)')
+
+    def __init__(self, handler=None, n_plus_one=5):
+        self.handler = handler
+        self.n_plus_one = n_plus_one
+        self.queries = []
+        self.shapes = collections.Counter()
+        self.time = 0.0
+
+    #语句的形状：sql中的参数都是占位符，只需要把in (%s, %s, ...)中数量不同的占位符归成一种
+    @classmethod
+    def shape(cls, sql):
+        return cls._in_re.sub('(...)', sql)
+
+    def record(self, sql, elapsed, rows):
+        shape = self.shape(sql)
+        self.queries.append((shape, elapsed, rows))
+        self.time += elapsed
+        self.shapes[shape] += 1
+        if self.shapes[shape] == self.n_plus_one + 1:
+            logging.warning('possible N+1 queries in handler %s: %s executed more than %s times' % (self.handler, shape, self.n_plus_one))
+
+    def summary(self):
+        return 'count=%s; time=%.1fms; shapes=%s' % (len(self.queries), self.time * 1000, len(self.shapes))
+
+#当前请求的sql追踪，None表示没有开启
+_trace = contextvars.ContextVar('orm_trace', default=None)
+
+#在with块中执行的sql都会记录到返回的QueryTrace中，app.py中的中间件为每个请求开启一次
+@contextlib.contextmanager
+def tracing(handler=None, n_plus_one=5):
+    trace = QueryTrace(handler, n_plus_one)
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+#慢查询日志：执行时间超过threshold秒的语句，在一个空闲的连接上用同样的sql和参数执行EXPLAIN，
+#把执行计划写到'orm.slow'日志中(一行json)；同一形状的语句每interval秒最多记录一次
+class SlowQueryLog(object):
+
+    _explainable = ('select', 'insert', 'update', 'delete', 'replace')
+
+    def __init__(self, threshold=0.5, interval=60):
+        self.threshold = threshold
+        self.interval = interval
+        self.logger = logging.getLogger('orm.slow')
+        self._last = dict()
+        self._tasks = set()
+
+    def check(self, sql, args, elapsed, rows):
+        if elapsed < self.threshold:
+            return
+        shape = QueryTrace.shape(sql)
+        now = time.monotonic()
+        if self._last.get(shape, -self.interval) + self.interval > now:
+            return
+        self._last[shape] = now
+        task = asyncio.ensure_future(self._log(shape, sql, args, elapsed, rows))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _log(self, shape, sql, args, elapsed, rows):
+        entry = collections.OrderedDict(shape=shape, seconds=round(elapsed, 6), rows=rows, plan=None)
+        try:
+            entry['plan'] = await self._explain(sql, args)
+        except Exception as e:
+            entry['explain_error'] = str(e)
+        self.logger.warning(json.dumps(entry, default=str))
+
+    async def _explain(self, sql, args):
+        if not sql.lstrip().lower().startswith(self._explainable):
+            return None
+        #只用空闲的连接，连接池已经用满的时候不再为了EXPLAIN去排队
+        pool = primary_pool()
+        if pool is None or pool.freesize == 0:
+            return None
+        async with acquire(pool) as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute('explain ' + compile_sql(sql), args or ())
+                return await cur.fetchall()
+
+#默认不开启，create_pool(slow_query=dict(threshold=..., interval=...))开启
+slow_log = None
+
+#每条语句执行完之后调用，记录耗时
+def _observe(sql, args, elapsed, rows):
+    trace = _trace.get()
+    if trace is not None:
+        trace.record(sql, elapsed, rows)
+    if slow_log is not None:
+        slow_log.check(sql, args, elapsed, rows)
+
+#unit of work：请求中Model的save/update/remove先放进队列，请求处理完之后在一个事务中一起执行；
+#同一张表、同一条语句的写合并成一组：insert用多行insert，update用executemany，delete合并成一条 where id in (...)
+#注意：队列中的写在flush之前，请求中后面的查询是看不到的
+class UnitOfWork(object):
+
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        #[(kind, model, sql, [(obj, args), ...]), ...]
+        self._groups = []
+
+    def add(self, kind, obj, sql, args):
+        model = obj.__model__
+        #和前面同一种写合并；中间如果有对同一张表的其他写，就不能越过它合并，保证同一张表的写的顺序
+        for group in reversed(self._groups):
+            if group[0] == kind and group[1] is model and group[2] == sql:
+                group[3].append((obj, args))
+                return
+            if group[1] is model:
+                break
+        self._groups.append((kind, model, sql, [(obj, args)]))
+
+    def __len__(self):
+        return sum(len(group[3]) for group in self._groups)
+
+    async def flush(self):
+        groups, self._groups = self._groups, []
+        if not groups:
+            return
+        async with transaction():
+            for kind, model, sql, items in groups:
+                if kind == 'delete':
+                    for i in range(0, len(items), self.batch_size):
+                        batch = items[i:i + self.batch_size]
+                        pks = [args[0] for obj, args in batch]
+                        rows = await execute('delete from `%s` where `%s` in (%s)' % (model.__table__, model.__primary_key__, create_args_string(len(pks))), pks)
+                        if rows != len(pks):
+                            logging.warn('failed to remove all records: expected %s, affected rows: %s' % (len(pks), rows))
+                else:
+                    counts = await executemany(sql, [args for obj, args in items], self.batch_size)
+                    if kind == 'insert' and sum(counts) != len(items):
+                        logging.warn('failed to insert all records: expected %s, affected rows: %s' % (len(items), sum(counts)))
+                invalidate(model.__table__)
+                if kind != 'update':
+                    for obj, args in items:
+                        count_rows(obj.counterKeys(), 1 if kind == 'insert' else -1)
+
+#当前请求的unit of work，None表示写操作直接执行
+_unit_of_work = contextvars.ContextVar('orm_unit_of_work', default=None)
+
+#async with orm.unit_of_work(): 块中的Model写操作在块正常结束时一起提交；块中抛出异常时全部丢弃
+@contextlib.asynccontextmanager
+async def unit_of_work(batch_size=100):
+    uow = UnitOfWork(batch_size)
+    token = _unit_of_work.set(uow)
+    try:
+        yield uow
+    finally:
+        _unit_of_work.reset(token)
+    await uow.flush()
+
+#语句执行超时，或者请求的截止时间已经过了；RequestHandler把它转换成503
+class QueryTimeoutError(Exception):
+    pass
+
+#当前请求的截止时间(time.monotonic())，None表示没有限制
+_deadline = contextvars.ContextVar('orm_deadline', default=None)
+
+#with orm.deadline(seconds): 块中的所有语句和获取连接都必须在截止时间之前完成；嵌套时取更早的截止时间
+@contextlib.contextmanager
+def deadline(seconds):
+    end = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(end if current is None else min(current, end))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+#一条语句最多可以执行的秒数：取参数timeout、create_pool的query_timeout和请求剩余时间中最小的一个，None表示没有限制
+def _timeout(timeout):
+    if timeout is None:
+        timeout = __query_timeout
+    end = _deadline.get()
+    if end is not None:
+        left = end - time.monotonic()
+        if left <= 0:
+            raise QueryTimeoutError('request deadline exceeded')
+        timeout = left if timeout is None else min(timeout, left)
+    return timeout
+
+#在timeout秒内执行aw，超时的时候关闭连接(连接池会丢弃它，之后重新创建)，并用另外一个连接KILL掉还在服务器上执行的语句
+async def _bounded(conn, aw, timeout):
+    if timeout is None:
+        return await aw
+    try:
+        return await asyncio.wait_for(aw, timeout)
+    except asyncio.TimeoutError:
+        await _cancel(conn)
+        raise QueryTimeoutError('statement timed out after %.3fs' % timeout)
+
+async def _cancel(conn):
+    thread_id = conn.thread_id()
+    conn.close()
+    dsn = __dsns.get(id(_owners.get(id(conn))))
+    if dsn is None:
+        return
+    try:
+        #服务器本身卡住的时候KILL也可能卡住，最多等2秒
+        await asyncio.wait_for(_kill(dsn, thread_id), 2)
+    except Exception as e:
+        logging.warning('failed to kill query on connection %s: %s' % (thread_id, e))
+
+async def _kill(dsn, thread_id):
+    killer = await aiomysql.connect(**dsn)
+    try:
+        async with killer.cursor() as cur:
+            await cur.execute('kill query %d' % thread_id)
+    finally:
+        killer.close()
+
 #执行select语句的函数，返回查询的结果
-async def select(sql, args, size=None):
+#raw=True时用普通游标，每一行返回一个tuple，列的顺序就是sql中select的顺序；timeout是这条语句最多执行的秒数
+async def select(sql, args, size=None, raw=False, timeout=None):
     log(sql, args)
-    global __pool
+    timeout = _timeout(timeout)
+    tx = _transaction.get()
+    if tx is not None:
+        return await _fetch(tx.conn, sql, args, size, raw, timeout)
+    #刚写过数据库的调用者不读缓存：缓存里可能是其他请求在写之后从落后的副本上读到、又放进去的旧数据
+    if query_cache is not None and not (__replicas and _recently_wrote()):
+        key = (sql, tuple(args or ()), size, raw)
+        rs = query_cache.get(key)
+        if rs is None:
+            version = query_cache.version
+            rs = await _load(sql, args, size, raw, timeout)
+            query_cache.put(key, sql, rs, version)
+        #返回副本，调用者修改列表不会影响缓存
+        return list(rs)
+    return await _load(sql, args, size, raw, timeout)
+
+#开启了single_flight时，合并正在执行的相同查询；合并的查询使用第一个调用者的截止时间。
+#刚写过数据库、必须读主库的调用者只和同样走主库的查询合并，不会拿到副本上的旧数据
+async def _load(sql, args, size, raw, timeout):
+    if single_flight is None:
+        return await _read(sql, args, size, raw, timeout)
+    primary = pick_replica() is None
+    key = (sql, tuple(args or ()), size, raw, primary)
+    return await single_flight.do(key, sql, lambda: _read(sql, args, size, raw, timeout, primary))
+
+#primary=True时不使用副本
+async def _read(sql, args, size, raw, timeout=None, primary=False):
+    replica = None if primary else pick_replica()
+    if replica is not None:
+        replica.in_flight += 1
+        try:
+            return await _select(replica.pool, sql, args, size, raw, timeout)
+        except (aiomysql.OperationalError, OSError) as e:
+            #副本连不上，摘除之后改到主库上执行
+            replica.fail(e)
+        finally:
+            replica.in_flight -= 1
+    return await _select(__pool, sql, args, size, raw, timeout)
+
+async def _select(pool, sql, args, size, raw, timeout):
     #获取数据库连接
-    async with __pool.get() as conn:
-        #获取数据库游标
-        #A cursor which returns results as a dictionary
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            #因为mysql的占位符是'?'，所以压要将'%s'替换成'?'。之后再利用cur执行sql语句
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                rs = await cur.fetchmany(size)
-            else:
-                rs = await cur.fetchall()
-        logging.info('rows returned: %s' % len(rs))
-        return rs
+    async with acquire(pool) as conn:
+        return await _fetch(conn, sql, args, size, raw, timeout)
+
+async def _fetch(conn, sql, args, size, raw, timeout=None):
+    start = time.monotonic()
+    #获取数据库游标
+    #A cursor which returns results as a dictionary
+    cur = await conn.cursor(aiomysql.Cursor if raw else aiomysql.DictCursor)
+    try:
+        rs = await _bounded(conn, _fetchrows(cur, sql, args, size), timeout)
+    finally:
+        #超时的连接已经关闭，不能再关闭游标(会一直等到服务器上的语句执行完)
+        if not conn.closed:
+            await cur.close()
+    logging.info('rows returned: %s' % len(rs))
+    _observe(sql, args, time.monotonic() - start, len(rs))
+    return rs
+
+async def _fetchrows(cur, sql, args, size):
+    #因为mysql的占位符是'%s'，所以要将'?'替换成'%s'(已经编译过的sql不会再替换)。之后再利用cur执行sql语句
+    await cur.execute(compile_sql(sql), args or ())
+    if size:
+        return await cur.fetchmany(size)
+    return await cur.fetchall()
+#流式查询：用服务端游标(unbuffered)执行，结果不会一次性全部读进内存，而是每次fetchmany一批交给调用者，
+#所以不管表有多大，内存里最多只有一批行。注意整个迭代过程中一直占用着一个连接
+#截止时间只在开始之前检查，迭代过程中不受限制
+async def iterate(sql, args, batch=500, raw=False):
+    log(sql, args)
+    _timeout(None)
+    tx = _transaction.get()
+    if tx is not None:
+        async for rs in _iterate(tx.conn, sql, args, batch, raw):
+            yield rs
+        return
+    replica = pick_replica()
+    pool = __pool if replica is None else replica.pool
+    if replica is not None:
+        replica.in_flight += 1
+    try:
+        async with acquire(pool) as conn:
+            async for rs in _iterate(conn, sql, args, batch, raw):
+                yield rs
+    finally:
+        if replica is not None:
+            replica.in_flight -= 1
+
+async def _iterate(conn, sql, args, batch, raw):
+    start, rows = time.monotonic(), 0
+    async with conn.cursor(aiomysql.SSCursor if raw else aiomysql.SSDictCursor) as cur:
+        await cur.execute(compile_sql(sql), args or ())
+        while True:
+            rs = await cur.fetchmany(batch)
+            if not rs:
+                break
+            rows += len(rs)
+            yield rs
+    #耗时包括调用者处理每一批数据的时间
+    _observe(sql, args, time.monotonic() - start, rows)
+
 #执行处select之外的其他语句，因为update, delete, insert这些操作期待的返回值都是影响的行数(或者成功与否)
 #所以可以用同一个执行函数来执行这三种操作，返回值：如果操作成功返回数据表中受影响的行数，如果操作失败raise error
-async def execute(sql, args, autocommit=True):
+#在事务中执行时，由事务负责提交或者回滚，autocommit参数不起作用
+async def execute(sql, args, autocommit=True, timeout=None):
     log(sql)
-    async with __pool.get() as conn:
+    timeout = _timeout(timeout)
+    tx = _transaction.get()
+    if tx is not None:
+        return await _execute(tx.conn, sql, args, timeout)
+    async with acquire(__pool) as conn:
         if not autocommit:
             await conn.begin()
         try:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql.replace('?', '%s'), args)
-                affected = cur.rowcount
+            affected = await _execute(conn, sql, args, timeout)
             if not autocommit:
                 await conn.commit()
+            _wrote()
         except BaseException as e:
-            if not autocommit:
+            if not autocommit and not conn.closed:
                 await conn.rollback()
             raise
         return affected
+
+async def _execute(conn, sql, args, timeout=None):
+    start = time.monotonic()
+    cur = await conn.cursor(aiomysql.DictCursor)
+    try:
+        await _bounded(conn, cur.execute(compile_sql(sql), args), timeout)
+        affected = cur.rowcount
+    finally:
+        if not conn.closed:
+            await cur.close()
+    _observe(sql, args, time.monotonic() - start, affected)
+    return affected
+#批量执行同一条语句：所有批次在同一个连接、同一个事务里用executemany执行(insert语句会被驱动改写成多行insert)，
+#返回每一批受影响的行数，任何一批失败都会回滚全部
+async def executemany(sql, seq_of_args, batch_size=100, timeout=None):
+    log(sql)
+    timeout = _timeout(timeout)
+    tx = _transaction.get()
+    if tx is not None:
+        return await _executemany(tx.conn, sql, seq_of_args, batch_size, timeout)
+    async with acquire(__pool) as conn:
+        await conn.begin()
+        try:
+            counts = await _executemany(conn, sql, seq_of_args, batch_size, timeout)
+            await conn.commit()
+            _wrote()
+        except BaseException as e:
+            if not conn.closed:
+                await conn.rollback()
+            raise
+    return counts
+
+#timeout是所有批次加起来最多执行的秒数
+async def _executemany(conn, sql, seq_of_args, batch_size, timeout=None):
+    counts = []
+    end = None if timeout is None else time.monotonic() + timeout
+    cur = await conn.cursor(aiomysql.DictCursor)
+    try:
+        for i in range(0, len(seq_of_args), batch_size):
+            start = time.monotonic()
+            await _bounded(conn, cur.executemany(compile_sql(sql), seq_of_args[i:i + batch_size]), None if end is None else end - start)
+            counts.append(cur.rowcount)
+            _observe(sql, seq_of_args[i], time.monotonic() - start, cur.rowcount)
+    finally:
+        if not conn.closed:
+            await cur.close()
+    return counts
+
 #根据参数的个数，创建预定义的参数列表:(?, ?, ?, ?)
 def create_args_string(num):
     L = []
@@ -71,44 +944,324 @@ def create_args_string(num):
         L.append('?')
     return ', '.join(L)
 
+#limit参数的形式：None、一个数字、或者(offset, limit)二元组，用来作为sql语句缓存的key的一部分
+def limit_form(limit):
+    if limit is None:
+        return 0
+    if isinstance(limit, int):
+        return 1
+    if isinstance(limit, tuple) and len(limit) == 2:
+        return 2
+    raise ValueError('Invalid limit value: %s' % str(limit))
+
 #model类属性的基本类型
 class Field(object):
-    #初始化方法，
-    def __init__(self, name, column_type, primary_key, default):
+    #初始化方法，index/unique表示需要在这一列上建普通索引/唯一索引
+    def __init__(self, name, column_type, primary_key, default, index=False, unique=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        self.index = index
+        self.unique = unique
     #重写__str__方法
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
 #继承自Field基本类型的string
 class StringField(Field):
     #初始化，并且调用父类的__init__方法， varchar: 不定长字符串，注意不能超过定义的长度，否则超过的部分被自动截断
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False, unique=False):
+        super().__init__(name, ddl, primary_key, default, index, unique)
 
 class BooleanField(Field):
 
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index)
 
 class IntegerField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False, unique=False):
+        super().__init__(name, 'bigint', primary_key, default, index, unique)
 
 class FloatField(Field):
 
-    def __init__(self, name=None, primary_key=False, default=0.0):
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
         #real:是sql的一种数据类型，一个real类型的数据占4个字节，它可以描述7个精度
-        super().__init__(name, 'real', primary_key, default)
+        super().__init__(name, 'real', primary_key, default, index)
 
 class TextField(Field):
 
     def __init__(self, name=None, default=None):
         super().__init__(name, 'text', False, default)
 
+#按时间排序的64位id(snowflake)：41位从EPOCH开始的毫秒数 + 10位worker + 12位毫秒内的序号，
+#同一个worker生成的id严格递增，不同进程/机器生成的id按时间大致有序(k-sorted)，插入时总是追加在索引的末尾
+class IdGenerator(object):
+
+    #2020-01-01 00:00:00 UTC，41位毫秒可以用到2089年
+    EPOCH = 1577836800000
+
+    #worker(0~1023)必须在所有同时生成id的进程之间唯一，由参数、configure()或者环境变量ORM_WORKER_ID指定；
+    #不能用主机名和进程号的哈希代替，1024个值里两个进程很容易重复，重复的worker会在同一毫秒生成相同的id
+    def __init__(self, worker=None):
+        self._lock = threading.Lock()
+        self._last = 0
+        self._seq = 0
+        self.worker = None
+        if worker is None:
+            worker = os.environ.get('ORM_WORKER_ID', None)
+        if worker is not None:
+            self.configure(worker)
+        #fork出来的子进程不能沿用父进程的worker，必须重新configure()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget)
+
+    def configure(self, worker):
+        worker = int(worker)
+        if not 0 <= worker <= 0x3ff:
+            raise ValueError('worker id must be between 0 and 1023: %s' % worker)
+        with self._lock:
+            self.worker = worker
+
+    def _forget(self):
+        self.worker = None
+        self._last = 0
+        self._seq = 0
+
+    def next(self):
+        if self.worker is None:
+            raise RuntimeError('IdGenerator has no worker id: set ORM_WORKER_ID or call orm.ids.configure(worker) in every process')
+        return self._next(self.worker)
+
+    def _next(self, worker):
+        with self._lock:
+            now = int(time.time() * 1000) - self.EPOCH
+            if now <= self._last:
+                #同一毫秒内(或者时钟回拨)沿用上一次的时间，序号用完了就借用下一毫秒，保证单调递增
+                now = self._last
+                self._seq = (self._seq + 1) & 0xfff
+                if self._seq == 0:
+                    now += 1
+            else:
+                self._seq = 0
+            self._last = now
+            return (now << 22) | (worker << 12) | self._seq
+
+    #128位id：高64位是按时间排序的id，低64位随机，所以不需要唯一的worker(没有指定时用0)
+    def next128(self):
+        high = self._next(self.worker if self.worker is not None else 0)
+        return (high << 64) | int.from_bytes(os.urandom(8), 'big')
+
+ids = IdGenerator()
+
+#id的文本形式：Crockford base32(小写，没有i l o u)，定长，所以文本的顺序和数值的顺序一致
+_KEY_ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+_KEY_VALUES = dict((c, i) for i, c in enumerate(_KEY_ALPHABET))
+
+def format_key(n, length=13):
+    chars = []
+    for i in range(length):
+        chars.append(_KEY_ALPHABET[n & 31])
+        n >>= 5
+    return ''.join(reversed(chars))
+
+def parse_key(text, length=13):
+    if not isinstance(text, str) or len(text) != length:
+        raise ValueError('Invalid key: %r' % (text,))
+    n = 0
+    for c in text.lower():
+        v = _KEY_VALUES.get(c)
+        if v is None:
+            raise ValueError('Invalid key: %r' % (text,))
+        n = (n << 5) | v
+    return n
+
+#紧凑的主键/外键：数据库中存bigint unsigned(8字节)或者binary(16)，model和API中是定长的base32文本(13或26个字符)，
+#比varchar(50)的next_id()小得多，每个二级索引都包含主键，所以索引也跟着变小。主键默认用ids生成新的id，
+#bigint的主键要求每个进程都指定了唯一的worker(ORM_WORKER_ID)，binary(16)的不需要
+class KeyField(Field):
+
+    def __init__(self, name=None, primary_key=False, default=None, binary=False, index=False, unique=False):
+        self.binary = binary
+        self.length = 26 if binary else 13
+        if default is None and primary_key:
+            default = self.generate
+        super().__init__(name, 'binary(16)' if binary else 'bigint unsigned', primary_key, default, index, unique)
+
+    def generate(self):
+        return format_key(ids.next128() if self.binary else ids.next(), self.length)
+
+    #文本 ==> 数据库中的值
+    def encode(self, text):
+        n = parse_key(text, self.length)
+        return n.to_bytes(16, 'big') if self.binary else n
+
+    #数据库中的值 ==> 文本
+    def decode(self, value):
+        return format_key(int.from_bytes(value, 'big') if self.binary else value, self.length)
+
+#索引的定义：名称、是否唯一、按顺序排列的列
+class Index(object):
+
+    def __init__(self, name, unique, columns):
+        self.name = name
+        self.unique = unique
+        self.columns = tuple(columns)
+
+    def sql(self, table):
+        return 'create %sindex `%s` on `%s` (%s)' % ('unique ' if self.unique else '', self.name, table, ', '.join('`%s`' % c for c in self.columns))
+
+    def __str__(self):
+        return '<Index %s%s: %s>' % ('unique ' if self.unique else '', self.name, ', '.join(self.columns))
+
+#根据字段的index/unique和model的__indexes__生成索引列表；__indexes__中每一项是列名的tuple，
+#或者dict(columns=(...), unique=True, name='...')
+def create_indexes(mappings, indexes):
+    result = []
+    for k, v in mappings.items():
+        if v.unique:
+            result.append(Index('uniq_%s' % k, True, (k,)))
+        elif v.index:
+            result.append(Index('idx_%s' % k, False, (k,)))
+    for item in indexes:
+        if not isinstance(item, dict):
+            item = dict(columns=item)
+        columns = tuple(item['columns'])
+        for k in columns:
+            if k not in mappings:
+                raise Exception('Index column not found: %s' % k)
+        unique = item.get('unique', False)
+        result.append(Index(item.get('name', None) or '%s_%s' % ('uniq' if unique else 'idx', '_'.join(columns)), unique, columns))
+    return result
+
+#生成把tuple游标返回的行直接转换成model实例的函数，names是每一列的名字(也就是sql中select的顺序)：
+#    def hydrate(rs):
+#        for r in rs:
+#            o = new(cls)
+#            o['id'], o['name'], ... = r
+#不创建中间的dict，也不经过__init__，所以实例是"没有修改过"的状态；KeyField的列在这里解码
+def create_hydrator(model, names):
+    codecs = model.__codecs__
+    env = dict(new=dict.__new__, cls=model)
+    lines = ['def hydrate(rs):', '    objs = []', '    append = objs.append']
+    if not any(k in codecs for k in names):
+        lines.append('    for r in rs:')
+        lines.append('        o = new(cls)')
+        lines.append('        %s, = r' % ', '.join('o[%r]' % k for k in names))
+    else:
+        values = ['v%d' % i for i in range(len(names))]
+        lines.append('    for %s, in rs:' % ', '.join(values))
+        lines.append('        o = new(cls)')
+        for k, v in zip(names, values):
+            if k in codecs:
+                env['decode_' + v] = codecs[k].decode
+                lines.append('        o[%r] = None if %s is None else decode_%s(%s)' % (k, v, v, v))
+            else:
+                lines.append('        o[%r] = %s' % (k, v))
+    lines.append('        append(o)')
+    lines.append('    return objs')
+    exec('\n'.join(lines), env)
+    return env['hydrate']
+
+#字符串主键按MySQL默认的collation(不区分大小写，比较时忽略末尾空格)比较
+def _collate(key):
+    if isinstance(key, str):
+        return key.casefold().rstrip(' ')
+    return key
+
+#紧凑行：每个model会生成一个对应的Row子类，字段值保存在__slots__里，直接用tuple游标返回的行填充，
+#不需要每一行都带一个列名字典，适合一次加载很多行的列表页
+class Row(object):
+    __slots__ = ()
+    #紧凑行不记录修改过的字段，update()写全部已加载的列
+    _changed = None
+
+    def __init__(self, *values, **kw):
+        for k, v in zip(self.__slots__, values):
+            setattr(self, k, v)
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+    #app.py中json.dumps(default=lambda o: o.__dict__)依赖这个属性序列化对象
+    @property
+    def __dict__(self):
+        return dict(self.items())
+
+    def keys(self):
+        return [k for k in self.__slots__ if hasattr(self, k)]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    #和dict一样支持 'passwd' in row、for k in row、row.get(k)，没有加载的列当作不存在的键
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        if key in self:
+            return getattr(self, key)
+        return default
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join('%s=%r' % kv for kv in self.items()))
+
+    def _clean(self):
+        pass
+
+#按主键合并加载(DataLoader)：同一个事件循环tick里对同一个model发起的find()，会在下一个tick合并成一次findMany()，
+#每个调用者拿到的是各自独立的实例，互相修改不会影响
+class Loader(object):
+
+    def __init__(self, model):
+        self.model = model
+        self._pending = dict()
+
+    async def load(self, pk):
+        fut = self._pending.get(pk)
+        if fut is None:
+            if not self._pending:
+                asyncio.get_event_loop().call_soon(self._dispatch)
+            fut = self._pending[pk] = asyncio.get_event_loop().create_future()
+        obj = await fut
+        return None if obj is None else self.model._copy(obj)
+
+    def _dispatch(self):
+        pending, self._pending = self._pending, dict()
+        asyncio.ensure_future(self._fetch(pending))
+
+    async def _fetch(self, pending):
+        try:
+            objs = await self.model.findMany(list(pending.keys()))
+        except BaseException as e:
+            for fut in pending.values():
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for fut, obj in zip(pending.values(), objs):
+            if not fut.done():
+                fut.set_result(obj)
+
+#当前请求的loader，每个model一个；None表示没有开启合并加载
+_loaders = contextvars.ContextVar('orm_loaders', default=None)
+
+#在with块中，Model.find()会通过Loader合并加载，app.py中的中间件为每个请求开启一次
+@contextlib.contextmanager
+def batch_loading():
+    token = _loaders.set(dict())
+    try:
+        yield
+    finally:
+        _loaders.reset(token)
+
 #python用来创建并实现ORM的魔术类
 class ModelMetaclass(type):
     #这个方法用于具体创建
@@ -147,19 +1300,126 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey # 主键属性名
         attrs['__fields__'] = fields # 除主键外的属性名
+        #需要按列维护行数的列，例如Comment按blog_id统计评论数
+        counters = tuple(attrs.get('__counters__', ()))
+        for k in counters:
+            if k not in mappings:
+                raise Exception('Counter column not found: %s' % k)
+        attrs['__counters__'] = counters
+        attrs['__indexes__'] = create_indexes(mappings, attrs.get('__indexes__', ()))
+        #数据库中的值和model中的值不一样的列(KeyField)，读写的时候需要转换
+        attrs['__codecs__'] = dict((k, v) for k, v in mappings.items() if hasattr(v, 'decode'))
+        #建表语句，二级索引单独用create index创建，方便和线上的表结构比较
+        attrs['__create_table__'] = 'create table `%s` (\n%s,\n  primary key (`%s`)\n) engine=innodb default charset=utf8' % (tableName, ',\n'.join('  `%s` %s not null' % (k, mappings[k].column_type) for k in [primaryKey] + fields), primaryKey)
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
-        attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
-        attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__find__'] = compile_sql('%s where `%s`=?' % (attrs['__select__'], primaryKey))
+        #固定的insert/update/delete语句在创建类的时候就编译好
+        attrs['__insert__'] = compile_sql('insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1)))
+        attrs['__update__'] = compile_sql('update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey))
+        attrs['__delete__'] = compile_sql('delete from `%s` where `%s`=?' % (tableName, primaryKey))
+        model = type.__new__(cls, name, bases, attrs)
+        model.__model__ = model
+        #列的顺序 ==> 生成的hydrate函数，所有列的顺序就是__select__的顺序
+        model.__hydrators__ = dict()
+        model.__hydrate__ = model._hydrator(tuple([primaryKey] + fields))
+        #生成紧凑行类型，slots的顺序和__select__中列的顺序一致，保存/更新/删除的方法和model共用
+        row = dict((k, attrs[k]) for k in ('__mappings__', '__table__', '__primary_key__', '__fields__', '__counters__', '__codecs__', '__insert__', '__update__', '__delete__'))
+        row['__slots__'] = tuple([primaryKey] + fields)
+        row['__model__'] = model
+        for k in ('getValue', 'getValueOrDefault', 'dbValue', 'insertArgs', 'counterKeys', '_queue', 'save', 'update', 'remove'):
+            row[k] = Model.__dict__[k]
+        model.__row__ = type('%sRow' % name, (Row,), row)
+        return model
+
+    #建表和建索引的全部语句
+    def ddl(cls):
+        return [cls.__create_table__] + [index.sql(cls.__table__) for index in cls.__indexes__]
+
+    #和线上数据库的表结构比较，返回需要执行的语句：表不存在时建表，缺少的列用alter table补上，缺少的索引(按列比较)用create index补上；
+    #线上多出来的列和索引不会删除，只输出日志
+    async def schemaDiff(cls):
+        rs = await select('select `column_name` `name` from information_schema.columns where table_schema=database() and table_name=?', [cls.__table__])
+        if not rs:
+            return cls.ddl()
+        columns = set(r['name'] for r in rs)
+        statements = []
+        for k in [cls.__primary_key__] + cls.__fields__:
+            if k not in columns:
+                statements.append('alter table `%s` add column `%s` %s not null' % (cls.__table__, k, cls.__mappings__[k].column_type))
+        for k in columns - set(cls.__mappings__):
+            logging.info('column %s.%s is not mapped by %s' % (cls.__table__, k, cls.__name__))
+        rs = await select('select `index_name` `name`, `non_unique` `non_unique`, `column_name` `col` from information_schema.statistics where table_schema=database() and table_name=? order by `index_name`, `seq_in_index`', [cls.__table__])
+        live = collections.OrderedDict()
+        for r in rs:
+            live.setdefault(r['name'], (not r['non_unique'], []))[1].append(r['col'])
+        live = dict(((unique, tuple(cols)), name) for name, (unique, cols) in live.items() if name != 'PRIMARY')
+        for index in cls.__indexes__:
+            if live.pop((index.unique, index.columns), None) is None:
+                statements.append(index.sql(cls.__table__))
+        for name in live.values():
+            logging.info('index %s.%s is not declared by %s' % (cls.__table__, name, cls.__name__))
+        return statements
 #所有model子类的父类，继承了dict和ModelMetaclass.
 #这样的好处是所有的model的子类隐形继承了metaclass，当创建实例时，python解释器会检查当前类的定义和父类的定义有没有metacalss，
 #如果有就会直接调用metaclass类的__new()__方法创建对象
 #又由于Model也继承了dict，所以堆属性的访问，可以使用a.b或者a[b]
 class Model(dict, metaclass=ModelMetaclass):
 
+    #从数据库加载之后修改过的字段：()表示没有修改；None表示不知道(直接创建的实例)，update()时写全部的字段
+    _changed = ()
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
+        self.__dict__['_changed'] = None
+
+    #用数据库返回的一行创建实例，不经过__init__，所以是"没有修改过"的状态
+    @classmethod
+    def load(cls, row):
+        obj = cls._copy(row)
+        if cls.__codecs__:
+            for k, field in cls.__codecs__.items():
+                value = obj.get(k)
+                if value is not None:
+                    dict.__setitem__(obj, k, field.decode(value))
+        return obj
+
+    #columns这种列顺序的tuple行 ==> 实例的函数，第一次用到的时候生成
+    @classmethod
+    def _hydrator(cls, columns):
+        if columns is None:
+            return cls.__hydrate__
+        hydrate = cls.__hydrators__.get(columns)
+        if hydrate is None:
+            hydrate = cls.__hydrators__[columns] = create_hydrator(cls, columns)
+        return hydrate
+
+    #复制一个已经加载的实例，值不再转换
+    @classmethod
+    def _copy(cls, obj):
+        new = dict.__new__(cls)
+        dict.update(new, obj)
+        return new
+
+    #model中的值 ==> 数据库中的值；where子句中KeyField列的参数也要先用它转换，例如Model.dbValue('blog_id', blog_id)
+    @classmethod
+    def dbValue(cls, key, value):
+        field = cls.__codecs__.get(key)
+        if field is None or value is None:
+            return value
+        return field.encode(value)
+
+    #数据库返回的tuple行 ==> model中的值，names是每一列的名字
+    @classmethod
+    def _decodeRows(cls, names, rs):
+        codecs = [(i, cls.__codecs__[k]) for i, k in enumerate(names) if k in cls.__codecs__]
+        rows = []
+        for r in rs:
+            r = list(r)
+            for i, field in codecs:
+                if r[i] is not None:
+                    r[i] = field.decode(r[i])
+            rows.append(r)
+        return rows
 
     def __getattr__(self, key):
         try:
@@ -167,8 +1427,19 @@ class Model(dict, metaclass=ModelMetaclass):
         except KeyError:
             raise AttributeError(r"'Model' object has no attribute '%s'" % key)
 
+    #通过属性赋值修改字段时记录下来，update()只写这些列；直接用obj[key] = value赋值不会被记录
     def __setattr__(self, key, value):
+        if key in self.__mappings__:
+            changed = self.__dict__.get('_changed', ())
+            if changed is not None and (key not in self or self[key] != value):
+                if not changed:
+                    changed = self.__dict__['_changed'] = set()
+                changed.add(key)
         self[key] = value
+
+    #保存或者更新之后，实例和数据库中的一致了
+    def _clean(self):
+        self.__dict__['_changed'] = ()
     #获取实例属性的值
     def getValue(self, key):
         return getattr(self, key, None)
@@ -190,69 +1461,303 @@ class Model(dict, metaclass=ModelMetaclass):
     async def findAll(cls, where=None, args=None, **kw):
         ' find objects by where clause. '
         #这个方法一般是由类名直接调用的，例如：User.findAll(args...)
-        sql = [cls.__select__]
+        orderBy = kw.get('orderBy', None)
+        limit = kw.get('limit', None)
+        form = limit_form(limit)
+        #columns=[...]时只查询这些列(以及主键)，返回部分model
+        columns = cls._projection(kw.get('columns', None))
+        #同样形状的查询只拼接、编译一次sql
+        sql = statements.get((cls, 'findAll', where, orderBy, form, columns), lambda: cls._selectSQL(where, orderBy, form, columns))
+        args = list(args) if args else []
+        if form == 1:
+            args.append(limit)
+        elif form == 2:
+            args.extend(limit)
+        #compact=True时返回紧凑行，省掉每一行的dict
+        if kw.get('compact', False):
+            rs = await select(sql, args, raw=True)
+            if cls.__codecs__:
+                rs = cls._decodeRows(columns or cls.__row__.__slots__, rs)
+            if columns is not None:
+                return [cls.__row__(**dict(zip(columns, r))) for r in rs]
+            return [cls.__row__(*r) for r in rs]
+        #tuple游标返回的行直接交给生成的hydrate函数创建实例，最后返回的是一个实例列表
+        rs = await select(sql, args, raw=True)
+        return cls._hydrator(columns)(rs)
+
+    @classmethod
+    async def iterAll(cls, where=None, args=None, batch=500, **kw):
+        ' iterate over all matching objects with a server-side cursor: async for obj in Model.iterAll(...) '
+        #用于导出、重建索引、回填数据等需要遍历整张表的场景
+        orderBy = kw.get('orderBy', None)
+        sql = statements.get((cls, 'iterAll', where, orderBy), lambda: cls._selectSQL(where, orderBy, 0))
+        async for rs in iterate(sql, args, batch, raw=True):
+            for obj in cls.__hydrate__(rs):
+                yield obj
+
+    #列投影：检查列名，主键和required中的列总是包含在内，列的顺序和__select__一致；columns为None表示所有列
+    @classmethod
+    def _projection(cls, columns, *required):
+        if columns is None:
+            return None
+        wanted = set(columns)
+        wanted.update(required)
+        for k in wanted:
+            if k not in cls.__mappings__:
+                raise ValueError('Invalid column: %s' % k)
+        return tuple([cls.__primary_key__] + [k for k in cls.__fields__ if k in wanted])
+
+    @classmethod
+    def _selectClause(cls, columns):
+        if columns is None:
+            return cls.__select__
+        return 'select %s from `%s`' % (', '.join('`%s`' % k for k in columns), cls.__table__)
+
+    @classmethod
+    def _selectSQL(cls, where, orderBy, form, columns=None):
+        sql = [cls._selectClause(columns)]
         #根据参数添加sql的子句
         if where:
             sql.append('where')
             sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
         if orderBy:
             sql.append('order by')
             sql.append(orderBy)
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?, ?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        #由于定义所有__***sql__的时候，都是list，所以最后拼接的时候直接每个子句空格隔开就行了
-        rs = await select(' '.join(sql), args)
-        #cla(**r)创建实例，最后返回的是一个实例列表
-        return [cls(**r) for r in rs]
+        if form == 1:
+            sql.append('limit ?')
+        elif form == 2:
+            sql.append('limit ?, ?')
+        #所有子句都放在list里，最后拼接的时候直接每个子句空格隔开就行了
+        return ' '.join(sql)
+
+    @classmethod
+    async def findAfter(cls, cursor=None, orderBy='created_at desc', limit=10, where=None, args=None, before=False, columns=None):
+        ' find objects after (or before) a (orderBy column, primary key) cursor, keyset pagination. '
+        #游标分页：用(排序列, 主键)定位上一页的最后一行，mysql可以直接从索引定位，不用像limit offset那样扫描再丢弃前面所有的行
+        col, desc = cls._cursorOrder(orderBy)
+        #生成下一页的游标需要排序列
+        columns = cls._projection(columns, col)
+        sql = statements.get((cls, 'findAfter', where, col, desc, before, cursor is None, columns), lambda: cls._afterSQL(where, col, desc, before, cursor is None, columns))
+        args = list(args) if args else []
+        if cursor is not None:
+            value, pk = cursor
+            value, pk = cls.dbValue(col, value), cls.dbValue(cls.__primary_key__, pk)
+            args.extend([value, value, pk])
+        args.append(limit)
+        rs = await select(sql, args, raw=True)
+        objs = cls._hydrator(columns)(rs)
+        #往前翻页的时候是反方向查询的，要把顺序翻转回来
+        if before:
+            objs.reverse()
+        return objs
+
+    @classmethod
+    def _cursorOrder(cls, orderBy):
+        parts = orderBy.split()
+        if len(parts) not in (1, 2) or parts[0] not in cls.__mappings__ or (len(parts) == 2 and parts[1].lower() not in ('asc', 'desc')):
+            raise ValueError('Invalid cursor orderBy value: %s' % orderBy)
+        return parts[0], len(parts) == 2 and parts[1].lower() == 'desc'
+
+    @classmethod
+    def _afterSQL(cls, where, col, desc, before, first, columns=None):
+        #往后翻页：降序时取更小的值，升序时取更大的值；往前翻页则相反
+        forward = desc != before
+        op = '<' if forward else '>'
+        direction = 'desc' if forward else 'asc'
+        conditions = []
+        if where:
+            conditions.append('(%s)' % where)
+        if not first:
+            conditions.append('(`{0}` {1} ? or (`{0}` = ? and `{2}` {1} ?))'.format(col, op, cls.__primary_key__))
+        sql = [cls._selectClause(columns)]
+        if conditions:
+            sql.append('where')
+            sql.append(' and '.join(conditions))
+        sql.append('order by `%s` %s, `%s` %s limit ?' % (col, direction, cls.__primary_key__, direction))
+        return ' '.join(sql)
 
     @classmethod
     async def findNumber(cls, selectField, where=None, args=None):
         ' find number by select and where. '
+        #整张表或者按__counters__中的列统计行数时，直接读计数器
+        key = cls._counterKey(selectField, where, args) if row_counters is not None else None
+        if key is not None:
+            n = row_counters.get(key)
+            if n is None:
+                version = row_counters.version
+                rs = await select(cls._countSQL(key[1]), None if key[1] is None else [cls.dbValue(key[1], key[2])], 1)
+                n = rs[0]['_num_']
+                row_counters.set(key, n, version)
+            return n
+        sql = statements.get((cls, 'findNumber', selectField, where), lambda: cls._numberSQL(selectField, where))
+        rs = await select(sql, args, 1)
+        if len(rs) == 0:
+            return None
+        return rs[0]['_num_']
+
+    _count_re = re.compile(r'^\s*`?(\w+)`?\s*=\s*\?\s*$')
+
+    @classmethod
+    def _counterKey(cls, selectField, where, args):
+        field = selectField.replace(' ', '').replace('`', '').lower()
+        if field != 'count(*)' and field != 'count(%s)' % cls.__primary_key__.lower():
+            return None
+        if not where:
+            return (cls, None, None)
+        m = cls._count_re.match(where)
+        if m and m.group(1) in cls.__counters__ and args and len(args) == 1:
+            return (cls, m.group(1), args[0])
+        return None
+
+    @classmethod
+    def _countSQL(cls, col):
+        return statements.get((cls, 'count', col), lambda: cls._numberSQL('count(*)', None if col is None else '`%s`=?' % col))
+
+    #计数器中和这个实例有关的key：整张表，以及__counters__中每一列的值
+    def counterKeys(self):
+        keys = [(self.__model__, None, None)]
+        for col in self.__counters__:
+            keys.append((self.__model__, col, self.getValue(col)))
+        return keys
+
+    @classmethod
+    def _numberSQL(cls, selectField, where):
         sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
-        if len(rs) == 0:
-            return None
-        return rs[0]['_num_']
+        return ' '.join(sql)
 
     @classmethod
-    async def find(cls, pk):
+    async def findMany(cls, pks):
+        ' find objects by a list of primary keys with one query, return them in input order (None if not found). '
+        keys = list(dict.fromkeys(pks))
+        if not keys:
+            return []
+        sql = statements.get((cls, 'findMany', len(keys)), lambda: '%s where `%s` in (%s)' % (cls.__select__, cls.__primary_key__, create_args_string(len(keys))))
+        if cls.__primary_key__ in cls.__codecs__:
+            keys = [cls.dbValue(cls.__primary_key__, k) for k in keys]
+            pks = [cls.dbValue(cls.__primary_key__, k) for k in pks]
+        rs = await select(sql, keys, raw=True)
+        #主键是每一行的第一列；MySQL按列的collation匹配in()，所以按同样的规则把返回的行对应回请求的主键
+        found = dict(zip([_collate(r[0]) for r in rs], cls.__hydrate__(rs)))
+        #有返回的行对应不上任何请求的主键(比如忽略重音的collation)，对没找到的主键再逐个按主键查询
+        if not found.keys() <= set(_collate(k) for k in keys):
+            for k in keys:
+                if _collate(k) not in found:
+                    rs = await select(cls.__find__, [k], 1, raw=True)
+                    if rs:
+                        found[_collate(k)] = cls.__hydrate__(rs)[0]
+        #同一个主键出现多次时，每一次都是独立的实例
+        objs, seen = [], set()
+        for pk in pks:
+            pk = _collate(pk)
+            obj = found.get(pk)
+            if obj is not None and pk in seen:
+                obj = cls._copy(obj)
+            seen.add(pk)
+            objs.append(obj)
+        return objs
+
+    @classmethod
+    async def find(cls, pk, columns=None):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        if columns is not None:
+            columns = cls._projection(columns)
+            sql = statements.get((cls, 'find', columns), lambda: '%s where `%s`=?' % (cls._selectClause(columns), cls.__primary_key__))
+            rs = await select(sql, [cls.dbValue(cls.__primary_key__, pk)], 1, raw=True)
+            return cls._hydrator(columns)(rs)[0] if rs else None
+        loaders = _loaders.get()
+        #事务中的连接不能被loader在另一个task里并发使用
+        if loaders is not None and _transaction.get() is None:
+            loader = loaders.get(cls)
+            if loader is None:
+                loader = loaders[cls] = Loader(cls)
+            return await loader.load(pk)
+        rs = await select(cls.__find__, [cls.dbValue(cls.__primary_key__, pk)], 1, raw=True)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return cls.__hydrate__(rs)[0]
 
-    async def save(self):
+    #insert语句的参数：先是其他字段，最后是主键，没有值的字段用默认值填充
+    def insertArgs(self):
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
+        if self.__codecs__:
+            args = [self.dbValue(k, v) for k, v in zip(self.__fields__ + [self.__primary_key__], args)]
+        return args
+
+    @classmethod
+    async def saveMany(cls, objs, batch_size=100):
+        ' insert objects in batches on one connection and one transaction, return rows written per batch. '
+        objs = list(objs)
+        if not objs:
+            return []
+        counts = await executemany(cls.__insert__, [obj.insertArgs() for obj in objs], batch_size)
+        invalidate(cls.__table__)
+        for obj in objs:
+            count_rows(obj.counterKeys(), 1)
+            obj._clean()
+        for n, rows in enumerate(counts):
+            logging.info('saveMany %s: batch %s wrote %s rows' % (cls.__table__, n, rows))
+        if sum(counts) != len(objs):
+            logging.warn('failed to insert all records: expected %s, affected rows: %s' % (len(objs), sum(counts)))
+        return counts
+
+    #请求开启了unit of work(并且不在显式事务中)时，写操作先放进队列，返回True
+    def _queue(self, kind, sql, args):
+        uow = _unit_of_work.get()
+        if uow is None or _transaction.get() is not None:
+            return False
+        uow.add(kind, self, sql, args)
+        return True
+
+    async def save(self):
+        args = self.insertArgs()
+        if self._queue('insert', self.__insert__, args):
+            self._clean()
+            return
         rows = await execute(self.__insert__, args)
+        invalidate(self.__table__)
+        self._clean()
+        count_rows(self.counterKeys(), rows)
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        changed = self._changed
+        if changed is not None:
+            #只更新加载之后修改过的列，没有修改就不用访问数据库
+            fields = [k for k in self.__fields__ if k in changed]
+        else:
+            #部分model(按列投影查询出来的)只更新已经加载的列，不能把没有查询的列写成NULL
+            fields = [k for k in self.__fields__ if k in self.keys()]
+        if not fields:
+            logging.debug('nothing to update for %s' % self.getValue(self.__primary_key__))
+            return
+        if len(fields) == len(self.__fields__):
+            sql = self.__update__
+        else:
+            sql = statements.get((self.__model__, 'update', tuple(fields)), lambda: 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join('`%s`=?' % k for k in fields), self.__primary_key__))
+        args = list(map(self.getValue, fields))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        if self.__codecs__:
+            args = [self.dbValue(k, v) for k, v in zip(fields + [self.__primary_key__], args)]
+        if self._queue('update', sql, args):
+            self._clean()
+            return
+        rows = await execute(sql, args)
+        invalidate(self.__table__)
+        self._clean()
         if rows != 1:
             logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
-        args = [self.getValue(self.__primary_key__)]
+        args = [self.dbValue(self.__primary_key__, self.getValue(self.__primary_key__))]
+        if self._queue('delete', self.__delete__, args):
+            return
         rows = await execute(self.__delete__, args)
+        invalidate(self.__table__)
+        count_rows(self.counterKeys(), -rows)
         if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
\ No newline at end of file
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Render blog content to html when the blog is written.
+
+usage: python3 render.py backfill    re-render the blogs rendered by an older renderer version
+'''
+
+import os, sys, asyncio, logging, functools, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import markdown2
+
+import orm
+from config import configs
+from models import Blog
+
+#渲染结果的格式变化时(markdown2升级、换了extras等)加一，backfill会重新渲染旧版本渲染的blog
+RENDERER_VERSION = 1
+
+#linear-spans：用线性时间的扫描代替回溯的正则查找代码和强调，输出相同，大量不成对的*和_不会拖慢渲染
+EXTRAS = ['linear-spans']
+
+#渲染进程的启动方式：forkserver启动的子进程不继承事件循环和数据库连接池的socket；Windows没有forkserver，用spawn
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def render_markdown(content):
+    return markdown2.markdown(content, extras=EXTRAS)
+
+#markdown渲染服务：Markdown.convert是纯python的cpu计算，大的文章会长时间占住事件循环，
+#所以超过threshold个字符的内容交给进程池渲染，小的内容直接在事件循环里渲染(以及命中markdown2的缓存)；
+#进程池中等待和正在渲染的任务最多max_queue个，满了之后新的调用者排队等待(backpressure)，不会无限堆积
+class RenderService(object):
+
+    def __init__(self, threshold=16384, workers=None, max_queue=None):
+        self.threshold = threshold
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue or self.workers * 4
+        #已经提交到进程池的任务数(包括正在渲染的)，以及因为队列满了在等待提交的调用者数
+        self.queued = 0
+        self.waiting = 0
+        self.inline = 0
+        self.offloaded = 0
+        self._executor = None
+        self._slots = None
+
+    async def render(self, content):
+        if len(content) < self.threshold:
+            self.inline += 1
+            return render_markdown(content)
+        cache = markdown2.render_cache
+        key = None if cache is None else cache.key(content, False, markdown2.DEFAULT_TAB_WIDTH, None, EXTRAS, False)
+        html = None if key is None else cache.get(key)
+        if html is not None:
+            return html
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_queue)
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.queued += 1
+        try:
+            html = await self._submit(content)
+        finally:
+            self.queued -= 1
+            self._slots.release()
+        self.offloaded += 1
+        if key is not None:
+            cache.put(key, html)
+        return html
+
+    async def _submit(self, content):
+        executor = self._pool()
+        try:
+            return await self._run(executor, content)
+        except BrokenProcessPool as e:
+            #有进程异常退出，进程池不能再用了：关闭它，在新的进程池上重试一次，仍然不在事件循环里渲染
+            logging.warning('render process pool is broken, retrying on a new pool: %s' % e)
+            #多个请求同时碰到同一个坏掉的进程池时，只有第一个关闭它，后面的不能把已经换上的新进程池关掉
+            if self._executor is executor:
+                self.shutdown()
+            return await self._run(self._pool(), content)
+
+    #进程池是在事件循环运行的时候创建的
+    def _pool(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(START_METHOD))
+        return self._executor
+
+    async def _run(self, executor, content):
+        #子进程只需要markdown2，不导入render模块(以及orm、config)
+        fn = functools.partial(markdown2.markdown, extras=EXTRAS)
+        return await asyncio.get_event_loop().run_in_executor(executor, fn, content)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self):
+        return dict(
+            workers=self.workers,
+            threshold=self.threshold,
+            queued=self.queued,
+            max_queue=self.max_queue,
+            waiting=self.waiting,
+            inline=self.inline,
+            offloaded=self.offloaded,
+            cache=markdown2.render_cache.stats() if markdown2.render_cache is not None else None
+        )
+
+service = RenderService()
+
+#按配置重新创建渲染服务，app.py启动的时候调用
+def configure(**kw):
+    global service
+    service.shutdown()
+    service = RenderService(**kw)
+    return service
+
+#把content渲染成html，和渲染器的版本一起保存在blog上，随blog一起写入数据库
+async def render_blog(blog):
+    blog.html_content = await service.render(blog.content)
+    blog.renderer_version = RENDERER_VERSION
+    return blog
+
+#blog页面用的html：保存的html是当前版本渲染的就直接用，否则(还没有backfill的旧blog)临时渲染一次
+async def blog_html(blog):
+    if blog.renderer_version == RENDERER_VERSION:
+        return blog.html_content
+    return await service.render(blog.content)
+
+#重新渲染所有不是当前版本渲染的blog，只更新html_content和renderer_version两列
+async def backfill(loop):
+    db = configs.db
+    await orm.create_pool(loop=loop, host=db.host, port=db.port, user=db.user, password=db.password, db=db.db)
+    n = 0
+    async for blog in Blog.iterAll('`renderer_version`<>?', [RENDERER_VERSION], batch=100):
+        await render_blog(blog)
+        await blog.update()
+        n += 1
+        if n % 100 == 0:
+            logging.info('rendered %s blogs' % n)
+    service.shutdown()
+    print('rendered %s blogs with renderer version %s' % (n, RENDERER_VERSION))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] != 'backfill':
+        print(__doc__)
+        sys.exit(1)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(backfill(loop))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Generate the database schema from the models.
+
+usage: python3 schema.py          print create table / create index statements
+       python3 schema.py diff     print the statements missing from the live database
+       python3 schema.py apply    execute the statements missing from the live database
+'''
+
+import sys, asyncio
+
+import orm
+from config import configs
+from models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+
+async def diff(loop, apply):
+    db = configs.db
+    await orm.create_pool(loop=loop, host=db.host, port=db.port, user=db.user, password=db.password, db=db.db)
+    for model in MODELS:
+        for sql in await model.schemaDiff():
+            print('%s;' % sql)
+            if apply:
+                await orm.execute(sql, ())
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'print'
+    if command == 'print':
+        for model in MODELS:
+            for sql in model.ddl():
+                print('%s;\n' % sql)
+    elif command in ('diff', 'apply'):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(diff(loop, command == 'apply'))
+    else:
+        print(__doc__)
+        sys.exit(1)